@@ -2,4 +2,11 @@
 
 __version__ = "1.6.0"
 
-from Plugwise_Smile import Smile
+import importlib
+
+
+def __getattr__(name):
+    """Import the Smile module on first use, the state module needs no aiohttp."""
+    if name == "Smile":
+        return importlib.import_module("Plugwise_Smile.Smile")
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
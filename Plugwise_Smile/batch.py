@@ -0,0 +1,161 @@
+"""Plugwise Smile batch module, analysing archived Smile XML dumps in parallel."""
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import os
+import time
+
+from Plugwise_Smile.state import SmileState
+
+# Dumps handed to a worker process at a time
+DEFAULT_CHUNKSIZE = 4
+
+# The files of a dump, in the layout of tests/<setup>/
+DUMP_FILES = {
+    "appliances": "core.appliances.xml",
+    "domain_objects": "core.domain_objects.xml",
+    "locations": "core.locations.xml",
+    "system": "system_status_xml.xml",
+}
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def find_dumps(root):
+    """Return the (sorted) directories below root holding a domain_objects dump."""
+    dumps = []
+    for path, dummy, files in os.walk(root):
+        if DUMP_FILES["domain_objects"] in files:
+            dumps.append(os.path.relpath(path, root))
+
+    return sorted(dumps)
+
+
+def analyse_dump(root, dump):
+    """
+    Identify the Smile of a dump and collect all device data.
+
+    The result holds dump, smile (identification), devices, device_data and
+    error (None, or the exception type and message), like a SmileFleet result.
+    """
+    result = {
+        "dump": dump,
+        "smile": None,
+        "devices": {},
+        "device_data": {},
+        "error": None,
+    }
+
+    documents = {}
+    for name, filename in DUMP_FILES.items():
+        try:
+            with open(os.path.join(root, dump, filename), "rb") as xml:
+                documents[name] = xml.read()
+        except FileNotFoundError:
+            documents[name] = None
+
+    try:
+        state = SmileState.from_documents(
+            documents["appliances"],
+            documents["domain_objects"],
+            documents["locations"],
+            system=documents["system"],
+        )
+        result["smile"] = {
+            "name": state.smile_name,
+            "type": state.smile_type,
+            "version": state.smile_version[0],
+            "legacy": state._smile_legacy,  # pylint: disable=protected-access
+        }
+        result["devices"] = state.get_all_devices()
+        result["device_data"] = state.get_all_device_data()
+    # pylint: disable=broad-except
+    except Exception as err:
+        # Record any failure, an exception would abort (and block resuming) the run
+        _LOGGER.debug("Analysing %s failed: %r", dump, err)
+        result["error"] = f"{type(err).__name__}: {err}"
+
+    return result
+
+
+def read_analysed(output):
+    """
+    Return the dumps already present in (a possibly interrupted) output.
+
+    A line cut off by an interruption is removed, that dump is analysed again.
+    """
+    analysed = set()
+    if not os.path.exists(output):
+        return analysed
+
+    complete = 0
+    with open(output, "rb+") as lines:
+        for line in lines:
+            try:
+                if not line.endswith(b"\n"):
+                    raise ValueError
+                analysed.add(json.loads(line)["dump"])
+            except (ValueError, KeyError):
+                break
+            complete += len(line)
+        lines.truncate(complete)
+
+    return analysed
+
+
+def analyse(root, output, processes=None, chunksize=DEFAULT_CHUNKSIZE):
+    """
+    Analyse all dumps below root, over processes (default all CPU cores).
+
+    Every result is appended to output as a JSON line, dumps present in output
+    are skipped, so an interrupted run continues where it stopped.
+    Return the amount of analysed, skipped and failed dumps, the duration (s)
+    and the throughput (dumps/s).
+    """
+    dumps = find_dumps(root)
+    done = read_analysed(output)
+    todo = [dump for dump in dumps if dump not in done]
+
+    stats = {"analysed": 0, "skipped": len(dumps) - len(todo), "errors": 0}
+    started = time.monotonic()
+    with open(output, "a", encoding="utf-8") as lines:
+        with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+            for result in executor.map(
+                analyse_dump, [root] * len(todo), todo, chunksize=chunksize
+            ):
+                # Device types are sets
+                lines.write(json.dumps(result, default=sorted) + "\n")
+                lines.flush()
+                stats["analysed"] += 1
+                if result["error"]:
+                    stats["errors"] += 1
+
+    stats["duration"] = time.monotonic() - started
+    stats["rate"] = stats["analysed"] / stats["duration"] if todo else 0.0
+    _LOGGER.debug("Batch analysis: %s", stats)
+    return stats
+
+
+def main(args=None):
+    """Analyse the dumps below a directory from the command line."""
+    parser = argparse.ArgumentParser(
+        description="Extract the device data of archived Smile XML dumps."
+    )
+    parser.add_argument("root", help="directory holding the dumps, like tests/")
+    parser.add_argument("output", help="JSON Lines file, appended to when present")
+    parser.add_argument("--processes", type=int, help="default: all CPU cores")
+    parser.add_argument("--chunksize", type=int, default=DEFAULT_CHUNKSIZE)
+    args = parser.parse_args(args)
+
+    stats = analyse(args.root, args.output, args.processes, args.chunksize)
+    print(
+        f"Analysed {stats['analysed']} dumps ({stats['errors']} failed, "
+        f"{stats['skipped']} skipped) in {stats['duration']:.2f}s: "
+        f"{stats['rate']:.1f} dumps/s"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,130 @@
+"""Plugwise Smile fleet module, polling many Smiles from one event loop."""
+
+import asyncio
+import logging
+import time
+
+from Plugwise_Smile.Smile import Smile
+from Plugwise_Smile.transport import CIRCUIT_OPEN, SharedTransport
+
+DEFAULT_FLEET_CONCURRENCY = 50
+DEFAULT_POLL_INTERVAL = 60
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class SmileFleet:
+    """Poll many Smiles, with a global concurrency cap and per-gateway intervals."""
+
+    def __init__(
+        self,
+        max_concurrent=DEFAULT_FLEET_CONCURRENCY,
+        interval=DEFAULT_POLL_INTERVAL,
+        transport: SharedTransport = None,
+    ):
+        """Set the constructor for this class."""
+        self.interval = interval
+        self.transport = transport or SharedTransport()
+        self.smiles = {}
+        # Latest result per gateway, see poll()
+        self.snapshot = {}
+
+        self._max_concurrent = max_concurrent
+        self._intervals = {}
+        self._next_poll = {}
+        # Created by the first poll(), a fleet is usually set up before its loop runs
+        self._slots = None
+
+    def add(self, name, smile: Smile, interval=None):
+        """Add a Smile to the fleet, polled every interval seconds."""
+        self.smiles[name] = smile
+        self._intervals[name] = interval or self.interval
+        self._next_poll[name] = 0
+
+    def add_gateway(self, name, host, password, interval=None, **kwargs):
+        """Create a Smile using the fleet transport and add it to the fleet."""
+        smile = Smile(host, password, transport=self.transport, **kwargs)
+        self.add(name, smile, interval)
+        return smile
+
+    async def remove(self, name):
+        """Remove a Smile from the fleet and close its connection."""
+        smile = self.smiles.pop(name)
+        self._intervals.pop(name)
+        self._next_poll.pop(name)
+        self.snapshot.pop(name, None)
+        await smile.close_connection()
+
+    def due(self, now=None):
+        """Return the names of the gateways due for polling."""
+        if now is None:
+            now = time.monotonic()
+        return [name for name, when in self._next_poll.items() if when <= now]
+
+    async def poll(self, names=None):
+        """
+        Poll the due (or given) gateways, bounded by max_concurrent.
+
+        Return a snapshot {name: result} of this cycle, every result holds:
+        devices, device_data ({dev_id: data}), duration (s) and error (or None).
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._max_concurrent)
+        if names is None:
+            names = self.due()
+
+        results = await asyncio.gather(*[self._poll_gateway(name) for name in names])
+        cycle = dict(zip(names, results))
+        self.snapshot.update(cycle)
+
+        failed = [name for name, result in cycle.items() if result["error"]]
+        if failed:
+            _LOGGER.debug("Fleet poll failed for %s of %s", len(failed), len(cycle))
+
+        return cycle
+
+    async def _poll_gateway(self, name):
+        """Connect (when needed) and collect all device data of one gateway."""
+        smile = self.smiles[name]
+        result = {"devices": {}, "device_data": {}, "duration": 0.0, "error": None}
+
+        # Skip unreachable gateways without waiting for a timeout
+        if smile.circuit_state == CIRCUIT_OPEN:
+            result["error"] = "CircuitOpenError"
+            self._next_poll[name] = time.monotonic() + self._intervals[name]
+            return result
+
+        async with self._slots:
+            started = time.monotonic()
+            try:
+                if smile.smile_type is None:
+                    await smile.connect()
+                else:
+                    await smile.full_update_device()
+
+                result["devices"], result["device_data"] = await smile.get_snapshot()
+            # pylint: disable=broad-except
+            except Exception as err:
+                # Any failure of one gateway is reported, it must not abort the poll
+                _LOGGER.debug("Polling %s failed: %r", name, err)
+                result["error"] = type(err).__name__
+            finally:
+                result["duration"] = time.monotonic() - started
+                self._next_poll[name] = started + self._intervals[name]
+
+        return result
+
+    async def run(self, callback=None):
+        """Keep polling all gateways on their intervals, until cancelled."""
+        while True:
+            cycle = await self.poll()
+            if callback is not None and cycle:
+                await callback(cycle)
+
+            wait = min(self._next_poll.values(), default=time.monotonic() + 1)
+            await asyncio.sleep(max(0, wait - time.monotonic()))
+
+    async def close(self):
+        """Close the connections of all Smiles in the fleet."""
+        for name in list(self.smiles):
+            await self.remove(name)
@@ -0,0 +1,1901 @@
+"""Plugwise Smile state, the XML data of a Smile and all data derived from it."""
+
+import bisect
+import copy
+import datetime as dt
+from functools import lru_cache
+import logging
+import re
+from types import MappingProxyType
+
+from lxml import etree
+
+_LOGGER = logging.getLogger(__name__)
+
+# An &-character not starting an entity or character reference
+ILLEGAL_AMPERSAND = re.compile(rb"&([^a-zA-Z#])")
+
+# Plugwise timestamps, i.e. 2020-03-20T18:19:40.926+01:00
+TIMESTAMP = re.compile(
+    r"(\d{4}-\d\d-\d\dT\d\d:\d\d:\d\d)(?:\.(\d+))?(Z|[+-]\d\d:?\d\d)?$"
+)
+TIMESTAMP_CACHE_SIZE = 1024
+
+# Formatted measurements kept, most measurements repeat between updates
+MEASURE_CACHE_SIZE = 4096
+
+SWITCH_GROUP_TYPES = ["switching", "report"]
+
+THERMOSTAT_CLASSES = [
+    "thermostat",
+    "zone_thermostat",
+    "thermostatic_radiator_valve",
+]
+
+# Schedule periods are formatted as [mo 07:00,mo 08:00)
+SCHEDULE_DAYS = {
+    "mo": 0,
+    "tu": 1,
+    "we": 2,
+    "th": 3,
+    "fr": 4,
+    "sa": 5,
+    "su": 6,
+}
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+HOME_MEASUREMENTS = {
+    "electricity_consumed": "power",
+    "electricity_produced": "power",
+    "gas_consumed": "gas",
+    "outdoor_temperature": "temperature",
+}
+
+# Excluded:
+# zone_thermosstat 'temperature_offset'
+# radiator_valve 'uncorrected_temperature', 'temperature_offset'
+DEVICE_MEASUREMENTS = {
+    # HA Core current_temperature
+    "temperature": "temperature",
+    # HA Core setpoint
+    "thermostat": "setpoint",
+    # Anna/Adam 
+    "boiler_temperature": "water_temperature",
+    "domestic_hot_water_state": "dhw_state",
+    "intended_boiler_temperature": "intended_boiler_temperature",  # non-zero when heating, zero when dhw-heating
+    "intended_central_heating_state": "heating_state", # use intended_c_h_state, this key shows the heating-behavior better than c-h_state
+    "modulation_level": "modulation_level",
+    "return_water_temperature": "return_temperature",
+    # Used with the Elga heatpump - marcelveldt
+    "compressor_state": "compressor_state",
+    "cooling_state": "cooling_state",
+    # Next 2 keys are used to show the state of the gas-heater used next to the Elga heatpump - marcelveldt
+    "slave_boiler_state": "slave_boiler_state",
+    "flame_state": "flame_state", # also present when there is a single gas-heater
+    # Anna only
+    "central_heater_water_pressure": "water_pressure",
+    "outdoor_temperature": "outdoor_temperature", # Outdoor temp as reported on the Anna, in the App
+    "schedule_temperature": "schedule_temperature", # Only present on legacy Anna and Anna_v3
+    # Legacy Anna: similar to flame-state on Anna/Adam
+    "boiler_state": "boiler_state",
+    # Legacy Anna: shows when heating is active, don't show dhw_state, cannot be determinded reliably
+    "intended_boiler_state": "intended_boiler_state",
+    # Lisa and Tom
+    "battery": "battery",
+    "temperature_difference": "temperature_difference",
+    "valve_position": "valve_position",
+    # Plug
+    "electricity_consumed": "electricity_consumed",
+    "electricity_produced": "electricity_produced",
+    "relay": "relay",
+}
+
+SMILES = {
+    "smile_open_therm_v3": {
+        "type": "thermostat",
+        "friendly_name": "Adam",
+    },
+    "smile_open_therm_v2": {
+        "type": "thermostat",
+        "friendly_name": "Adam",
+    },
+    "smile_thermo_v4": {
+        "type": "thermostat",
+        "friendly_name": "Anna",
+    },
+    "smile_thermo_v3": {
+        "type": "thermostat",
+        "friendly_name": "Anna",
+    },
+    "smile_thermo_v1": {
+        "type": "thermostat",
+        "friendly_name": "Anna",
+        "legacy": True,
+    },
+    "smile_v4": {
+        "type": "power",
+        "friendly_name": "P1",
+    },
+    "smile_v3": {
+        "type": "power",
+        "friendly_name": "P1",
+    },
+    "smile_v2": {
+        "type": "power",
+        "friendly_name": "P1",
+        "legacy": True,
+    },
+    "stretch_v3": {"type": "stretch", "friendly_name": "Stretch", "legacy": True},
+    "stretch_v2": {"type": "stretch", "friendly_name": "Stretch", "legacy": True},
+}
+
+# Identification and XML documents kept when pickling a SmileState
+STATE_ATTRIBUTES = (
+    "smile_hostname",
+    "smile_name",
+    "smile_type",
+    "smile_version",
+    "gateway_id",
+    "_smile_legacy",
+    "_incremental_extraction",
+)
+STATE_DOCUMENTS = ("_appliances", "_domain_objects", "_locations")
+
+
+@lru_cache(maxsize=TIMESTAMP_CACHE_SIZE)
+def parse_timestamp(timestamp):
+    """Parse a Plugwise (ISO 8601) timestamp into a datetime."""
+    try:
+        return dt.datetime.fromisoformat(timestamp)
+    except ValueError:
+        # Before python 3.11 only 3 or 6 fraction digits and no Z are accepted
+        match = TIMESTAMP.match(timestamp)
+        if match is None:
+            raise
+
+    moment, fraction, offset = match.groups()
+    if fraction:
+        moment = f"{moment}.{fraction[:6].ljust(6, '0')}"
+    if offset == "Z":
+        offset = "+00:00"
+    elif offset and ":" not in offset:
+        offset = f"{offset[:3]}:{offset[3:]}"
+    return dt.datetime.fromisoformat(moment + (offset or ""))
+
+
+class SmileState:
+    """
+    Define the data of a Smile, without any I/O.
+
+    Holds the retrieved XML documents and derives the devices, device data,
+    presets and schedules from them, see Smile for retrieving the documents.
+    """
+
+    # pylint: disable=too-many-instance-attributes, too-many-public-methods
+
+    def __init__(self, incremental_extraction=False):
+        """
+        Set the constructor for this class.
+
+        With incremental_extraction the measurements of a log are only read
+        again when its updated_date changed, see _index_measurements.
+        """
+        self._incremental_extraction = incremental_extraction
+        # Measurements per log of the previous tree of each endpoint
+        self._measured_logs = {}
+        self._appliances = None
+        self._domain_objects = None
+        self._home_location = None
+        self._locations = None
+        self._smile_legacy = False
+        self._thermo_master_id = None
+        # Derived from the XML data, see _get_topology
+        self._topology = None
+        self._topology_source = ()
+        # Element and measurement indexes per XML tree, see _get_tree_index
+        self._tree_indexes = []
+        # Presets per location, see _get_presets
+        self._presets = {}
+        # Compiled timeline per schedule rule, see _get_schedule_timeline
+        self._schedule_rules = None
+        self._schedule_timelines = {}
+        # Merged timeline per location, see _get_location_timeline
+        self._location_timelines = {}
+        # Raw inputs and device data per device of the previous get_changes
+        self._previous_device_data = None
+
+        self.active_device_present = False
+        self.gateway_id = None
+        self.heater_id = None
+        self.notifications = {}
+        # Amount of illegal &-characters repaired in the received XML
+        self.xml_repairs = 0
+        self.smile_hostname = None
+        self.smile_name = None
+        self.smile_type = None
+        self.smile_version = ()
+
+    @classmethod
+    def from_documents(
+        cls,
+        appliances,
+        domain_objects,
+        locations,
+        smile_type=None,
+        legacy=False,
+        smile_name=None,
+        smile_version=(),
+        system=None,
+    ):
+        """
+        Create the state of a Smile from its XML documents (bytes).
+
+        Use None for the appliances of a legacy P1, a non-legacy Smile without
+        appliances and locations derives these from domain_objects.
+        Without smile_type the Smile is identified from domain_objects and the
+        system document (legacy P1 and Stretch only), see identify.
+        """
+        state = cls()
+        trees = [
+            None if data is None else state._parse_document(data, None, name)
+            for data, name in [
+                (appliances, "appliances"),
+                (domain_objects, "domain_objects"),
+                (locations, "locations"),
+            ]
+        ]
+
+        if smile_type is None:
+            if system is not None:
+                system = state._parse_document(system, None, "system")
+            state.identify(trees[1], system)
+        else:
+            state.smile_type = smile_type
+            state.smile_name = smile_name
+            state.smile_version = smile_version
+            state._smile_legacy = legacy
+
+        if not state._smile_legacy and trees[0] is None and trees[2] is None:
+            trees[0] = trees[2] = trees[1]
+        state._set_documents(*trees)
+        return state
+
+    def _get_system_document(self, domain_objects):
+        """
+        Determine the system document needed to identify a legacy Smile.
+
+        Return status (P1), system (Stretch) or None when domain_objects will do.
+        """
+        dsmrmain = domain_objects.find(".//module/protocols/dsmrmain")
+        names = [name.text for name in domain_objects.findall(".//module/vendor_name")]
+        if "Plugwise" not in names and dsmrmain is None:
+            _LOGGER.error(
+                "Connected but expected text not returned, \
+                          we got %s",
+                domain_objects,
+            )
+            raise self.ConnectionFailedError
+
+        if domain_objects.find(".//gateway") is not None:
+            return None
+        # Try if it is a legacy Anna, assuming appliance thermostat
+        if domain_objects.find('.//appliance[type="thermostat"]') is not None:
+            return None
+        network = domain_objects.find(".//module/protocols/network_router/network")
+        if dsmrmain is not None:
+            return "status"
+        if network is not None:
+            return "system"
+
+        _LOGGER.error("Connected but no gateway device information found")
+        raise self.ConnectionFailedError
+
+    def identify(self, domain_objects, system=None):
+        """
+        Identify the Smile from domain_objects (XML).
+
+        A legacy P1 or Stretch also needs its system document, see
+        _get_system_document.
+        """
+        document = self._get_system_document(domain_objects)
+        gateway = domain_objects.find(".//gateway")
+
+        model = version = None
+        if gateway is not None:
+            if gateway.find("hostname") is not None:
+                self.smile_hostname = gateway.find("hostname").text
+            model = domain_objects.find(".//gateway/vendor_model").text
+            version = domain_objects.find(".//gateway/firmware_version").text
+        else:
+            # Assume legacy
+            self._smile_legacy = True
+            # Fake insert version assuming Anna
+            # couldn't find another way to identify as legacy Anna
+            version = "1.8.0"
+            model = "smile_thermo"
+            if document is not None and system is None:
+                _LOGGER.error("Legacy Smile, but no %s information", document)
+                raise self.ConnectionFailedError
+
+            # P1 legacy:
+            if document == "status":
+                version = system.find(".//system/version").text
+                model = system.find(".//system/product").text
+                self.smile_hostname = system.find(".//network/hostname").text
+
+            # Stretch:
+            if document == "system":
+                network = domain_objects.find(
+                    ".//module/protocols/network_router/network"
+                )
+                version = system.find(".//gateway/firmware").text
+                model = system.find(".//gateway/product").text
+                self.smile_hostname = system.find(".//gateway/hostname").text
+                self.gateway_id = network.attrib["id"]
+
+        if model is None or version is None:
+            _LOGGER.error("Unable to find model or version information")
+            raise self.UnsupportedDeviceError
+
+        # Version detection, imported here to keep importing this module light
+        import semver  # pylint: disable=import-outside-toplevel
+
+        ver = semver.parse(version)
+        target_smile = f"{model}_v{ver['major']}"
+
+        _LOGGER.debug("Plugwise identified as %s", target_smile)
+
+        if target_smile not in SMILES:
+            _LOGGER.error(
+                'Your version Smile identified as "%s" \
+                          seems unsupported by our plugin, please create \
+                          an issue on github.com/plugwise/Plugwise-Smile!\
+                          ',
+                target_smile,
+            )
+            raise self.UnsupportedDeviceError
+
+        self.smile_name = SMILES[target_smile]["friendly_name"]
+        self.smile_type = SMILES[target_smile]["type"]
+        self.smile_version = (version, ver)
+
+        if "legacy" in SMILES[target_smile]:
+            self._smile_legacy = SMILES[target_smile]["legacy"]
+
+    def _parse_document(self, data, encoding, command):
+        """Parse a complete XML document (bytes), repairing illegal &-characters."""
+        # pylint: disable=raise-missing-from
+        try:
+            return etree.fromstring(
+                self._repair_xml(data, command), etree.XMLParser(encoding=encoding)
+            )
+        except etree.XMLSyntaxError:
+            _LOGGER.error("Smile returns invalid XML for %s", command)
+            raise self.InvalidXMLError
+
+    def _set_documents(self, appliances, domain_objects, locations):
+        """Replace the XML data, all derived data follows the new documents."""
+        if domain_objects is None:
+            _LOGGER.error("Domain_objects data missing")
+            raise self.XMLDataMissingError
+
+        self._appliances = appliances
+        self._domain_objects = domain_objects
+        self._locations = locations
+        self._update_notifications()
+
+    def __getstate__(self):
+        """Keep the identification and the (serialized) XML documents only."""
+        state = {name: getattr(self, name) for name in STATE_ATTRIBUTES}
+        serialized = {}
+        for name in STATE_DOCUMENTS:
+            tree = getattr(self, name)
+            if tree is not None:
+                # Documents shared by the endpoints stay shared, see from_documents
+                if id(tree) not in serialized:
+                    serialized[id(tree)] = etree.tostring(tree)
+                tree = serialized[id(tree)]
+            state[name] = tree
+
+        return state
+
+    def __setstate__(self, state):
+        """Restore the state, the derived data is rebuilt on use."""
+        SmileState.__init__(self)
+        parsed = {}
+        trees = []
+        for name in STATE_DOCUMENTS:
+            data = state.pop(name)
+            if data is not None:
+                if id(data) not in parsed:
+                    parsed[id(data)] = etree.fromstring(data)
+                data = parsed[id(data)]
+            trees.append(data)
+
+        for name, value in state.items():
+            setattr(self, name, value)
+        self._set_documents(*trees)
+
+    def get_state(self):
+        """Return a SmileState of the current XML data, i.e. to pickle a Smile."""
+        state = SmileState()
+        for name in STATE_ATTRIBUTES + STATE_DOCUMENTS:
+            setattr(state, name, getattr(self, name))
+        state.notifications = dict(self.notifications)
+        return state
+
+    def _update_notifications(self):
+        """Collect the Plugwise notifications present in domain_objects."""
+        # If Plugwise notifications present:
+        self.notifications = {}
+        notifications = self._domain_objects.findall(".//notification")
+        for notification in notifications:
+            try:
+                msg_id = notification.attrib["id"]
+                msg_type = notification.find("type").text
+                msg = notification.find("message").text
+                self.notifications.update({msg_id: {msg_type: msg}})
+                _LOGGER.debug("Plugwise System notifications: %s", self.notifications)
+            except AttributeError:
+                _LOGGER.info(
+                    "Plugwise System Error Notification present but unable to process, manually investigate: %s",
+                    "domain_objects",
+                )
+
+    @staticmethod
+    def _types_finder(data):
+        """Detect types within locations from logs."""
+        types = set([])
+        for measure, measure_type in HOME_MEASUREMENTS.items():
+            locator = f".//logs/point_log[type='{measure}']"
+            if data.find(locator) is not None:
+                log = data.find(locator)
+
+                if measure == "outdoor_temperature":
+                    types.add(measure_type)
+
+                p_locator = ".//electricity_point_meter"
+                if log.find(p_locator) is not None:
+                    if log.find(p_locator).get("id"):
+                        types.add(measure_type)
+
+        return types
+
+    def _get_topology(self):
+        """
+        Return the topology derived from the XML data.
+
+        Built once for each set of retrieved XML data, all appliance, location,
+        thermostat and device overviews are read from it.
+        """
+        source = (self._appliances, self._domain_objects, self._locations)
+        if self._topology is not None and all(
+            new is old for new, old in zip(source, self._topology_source)
+        ):
+            return self._topology
+
+        locations, home_location = self._build_locations()
+        # Registering appliances alters the home location types, use a copy
+        appliances = self._build_appliances(
+            self._copy_details(locations), home_location
+        )
+        matched_locations = self._match_locations(
+            self._copy_details(locations), appliances
+        )
+        thermo_locations = self._scan_thermostats(
+            self._copy_details(matched_locations), home_location, appliances
+        )
+        group_switches = self._build_group_switches()
+        devices = self._build_devices(
+            self._copy_details(appliances),
+            thermo_locations,
+            home_location,
+            group_switches,
+        )
+
+        # The elected master and slaves per thermostat location
+        thermostats = MappingProxyType(
+            {
+                loc_id: MappingProxyType(
+                    {
+                        "master": details["master"],
+                        "master_prio": details["master_prio"],
+                        "slaves": frozenset(details["slaves"]),
+                    }
+                )
+                for loc_id, details in thermo_locations.items()
+                if "master_prio" in details
+            }
+        )
+
+        self._topology_source = source
+        self._topology = {
+            "locations": locations,
+            "home_location": home_location,
+            "appliances": appliances,
+            "matched_locations": matched_locations,
+            "thermo_locations": thermo_locations,
+            "thermostats": thermostats,
+            "group_switches": group_switches,
+            "devices": devices,
+        }
+        return self._topology
+
+    @staticmethod
+    def _copy_details(items):
+        """Copy the details per item, so the topology can't be altered by callers."""
+        return {
+            item_id: {
+                key: value.copy() if isinstance(value, (dict, list, set)) else value
+                for key, value in details.items()
+            }
+            for item_id, details in items.items()
+        }
+
+    def get_all_appliances(self):
+        """Determine available appliances from inventory."""
+        return self._copy_details(self._get_topology()["appliances"])
+
+    def get_all_locations(self):
+        """Determine available locations from inventory."""
+        topology = self._get_topology()
+        return self._copy_details(topology["locations"]), topology["home_location"]
+
+    def _build_appliances(self, locations, home_location):
+        """Determine available appliances from inventory."""
+        appliances = {}
+
+        if self._smile_legacy and self.smile_type == "power":
+            # Inject home_location as dev_id for legacy so
+            # get_appliance_data can use loc_id for dev_id.
+            appliances[self._home_location] = {
+                "name": "P1",
+                "types": set(["power", "home"]),
+                "class": "gateway",
+                "location": home_location,
+            }
+            self.gateway_id = self._home_location
+
+            return appliances
+
+        # TODO: add locations with members as appliance as well
+        # example 'electricity consumed/produced and relay' on Adam
+        # Basically walk locations for 'members' not set[] and
+        # scan for the same functionality
+
+        # Find gateway and heater devices
+        for appliance in self._appliances.findall("appliance"):
+            if appliance.find("type").text == "gateway":
+                self.gateway_id = appliance.attrib["id"]
+            if appliance.find("type").text == "heater_central":
+                self.heater_id = appliance.attrib["id"]
+
+        # for legacy it is the same device
+        if self._smile_legacy and self.smile_type == "thermostat":
+            self.gateway_id = self.heater_id
+
+        for appliance in self._appliances.findall("appliance"):
+            appliance_location = None
+            appliance_types = set([])
+
+            appliance_id = appliance.attrib["id"]
+            appliance_class = appliance.find("type").text
+            appliance_name = appliance.find("name").text
+
+            # Nothing useful in opentherm so skip it
+            if appliance_class == "open_therm_gateway":
+                continue
+
+            # Appliance with location (i.e. a device)
+            if appliance.find("location") is not None:
+                appliance_location = appliance.find("location").attrib["id"]
+                for appl_type in self._types_finder(appliance):
+                    appliance_types.add(appl_type)
+            else:
+                # Return all types applicable to home
+                appliance_types = locations[home_location]["types"]
+                # If heater or gatweay override registering
+                if appliance_class == "heater_central":
+                    appliance_id = self.heater_id
+                    appliance_name = self.smile_name
+                if appliance_class == "gateway":
+                    appliance_id = self.gateway_id
+                    appliance_name = self.smile_name
+
+            # Determine appliance_type from funcitonality
+            if (
+                appliance.find(".//actuator_functionalities/relay_functionality")
+                is not None
+                or appliance.find(".//actuators/relay") is not None
+            ):
+                appliance_types.add("plug")
+            elif (
+                appliance.find(".//actuator_functionalities/thermostat_functionality")
+                is not None
+            ):
+                appliance_types.add("thermostat")
+
+            appliances[appliance_id] = {
+                "name": appliance_name,
+                "types": appliance_types,
+                "class": appliance_class,
+                "location": appliance_location,
+            }
+
+        return appliances
+
+    def _build_locations(self):
+        """Determine available locations from inventory."""
+        home_location = None
+        locations = {}
+
+        # Legacy Anna without outdoor_temp and Stretches have no locations, create one containing all appliances
+        if self._locations.find("location") is None and self._smile_legacy:
+            appliances = set([])
+            home_location = 0
+
+            # Add Anna appliances
+            for appliance in self._appliances.findall("appliance"):
+                appliances.add(appliance.attrib["id"])
+
+            if self.smile_type == "thermostat":
+                locations[0] = {
+                    "name": "Legacy Anna",
+                    "types": set(["temperature"]),
+                    "members": appliances,
+                }
+            if self.smile_type == "stretch":
+                locations[0] = {
+                    "name": "Legacy Stretch",
+                    "types": set(["power"]),
+                    "members": appliances,
+                }
+
+            self._home_location = home_location
+
+            return locations, home_location
+
+        for location in self._locations.findall("location"):
+            location_name = location.find("name").text
+            location_id = location.attrib["id"]
+            location_types = set([])
+            location_members = set([])
+
+            # Group of appliances
+            locator = ".//appliances/appliance"
+            if location.find(locator) is not None:
+                for member in location.findall(locator):
+                    location_members.add(member.attrib["id"])
+
+            if location_name == "Home":
+                home_location = location_id
+                location_types.add("home")
+
+                for location_type in self._types_finder(location):
+                    location_types.add(location_type)
+
+            # Legacy P1 right location has 'services' filled
+            # test data has 5 for example
+            locator = ".//services"
+            if (
+                self._smile_legacy
+                and self.smile_type == "power"
+                and len(location.find(locator)) > 0
+            ):
+                # Override location name found to match
+                location_name = "Home"
+                home_location = location_id
+                location_types.add("home")
+                location_types.add("power")
+
+            locations[location_id] = {
+                "name": location_name,
+                "types": location_types,
+                "members": location_members,
+            }
+
+        self._home_location = home_location
+
+        return locations, home_location
+
+    @property
+    def thermostats(self):
+        """Return the elected master and slaves per thermostat location, read-only."""
+        return self._get_topology()["thermostats"]
+
+    def single_master_thermostat(self):
+        """Determine if there is a single master thermostat in the setup."""
+        count = 0
+        for dummy, data in self.thermostats.items():
+            if data["master_prio"] > 0:
+                count += 1
+
+        if count == 0:
+            return None
+        if count == 1:
+            return True
+        return False
+
+    def scan_thermostats(self, debug_text="missing text"):
+        """Update locations with actual master/slave thermostats."""
+        topology = self._get_topology()
+        return (
+            self._copy_details(topology["thermo_locations"]),
+            topology["home_location"],
+        )
+
+    def _scan_thermostats(self, locations, home_location, appliances):
+        """Update locations with actual master/slave thermostats."""
+        thermo_matching = {
+            "thermostat": 3,
+            "zone_thermostat": 2,
+            "thermostatic_radiator_valve": 1,
+        }
+
+        # Bucket the thermostats per location, in the order of appliances
+        thermostats = {}
+        for appliance_id, appliance_details in appliances.items():
+            if appliance_details["class"] in thermo_matching:
+                location = appliance_details["location"] or None
+                thermostats.setdefault(location, []).append(appliance_id)
+        order = {appliance_id: index for index, appliance_id in enumerate(appliances)}
+
+        scanned = False
+        for loc_id, location_details in locations.items():
+            locations[loc_id] = location_details
+
+            if "thermostat" in location_details["types"] and loc_id != home_location:
+                locations[loc_id].update(
+                    {"master": None, "master_prio": 0, "slaves": set([])}
+                )
+            elif loc_id == home_location and self._smile_legacy:
+                locations[loc_id].update(
+                    {"master": None, "master_prio": 0, "slaves": set([])}
+                )
+            else:
+                continue
+
+            scanned = True
+            members = thermostats.get(loc_id, [])
+            # Legacy thermostats without location belong to every location
+            if self._smile_legacy and loc_id is not None:
+                members = sorted(members + thermostats.get(None, []), key=order.get)
+
+            for appliance_id in members:
+                appl_class = appliances[appliance_id]["class"]
+
+                # Pre-elect new master
+                if thermo_matching[appl_class] > locations[loc_id]["master_prio"]:
+
+                    # Demote former master
+                    if locations[loc_id]["master"] is not None:
+                        locations[loc_id]["slaves"].add(locations[loc_id]["master"])
+
+                    # Crown master
+                    locations[loc_id]["master_prio"] = thermo_matching[appl_class]
+                    locations[loc_id]["master"] = appliance_id
+
+                else:
+                    locations[loc_id]["slaves"].add(appliance_id)
+
+            if locations[loc_id]["master"] is None:
+                _LOGGER.debug(
+                    "Location %s has no (master) thermostat", location_details["name"]
+                )
+
+        # Find highest ranking thermostat, the first one when there are more
+        ranked = [
+            (thermo_matching[appliance_details["class"]], appliance_id)
+            for appliance_id, appliance_details in appliances.items()
+            if appliance_details["class"] in thermo_matching
+        ]
+        if scanned and ranked:
+            self._thermo_master_id = max(ranked, key=lambda rank: rank[0])[1]
+
+        # Return location including slaves
+        return locations
+
+    def match_locations(self):
+        """Update locations with used types of appliances."""
+        topology = self._get_topology()
+        return (
+            self._copy_details(topology["matched_locations"]),
+            topology["home_location"],
+        )
+
+    def _match_locations(self, locations, appliances):
+        """Update locations with used types of appliances."""
+        match_locations = {}
+
+        for location_id, location_details in locations.items():
+            for dummy, appliance_details in appliances.items():
+                if appliance_details["location"] == location_id:
+                    for appl_type in appliance_details["types"]:
+                        location_details["types"].add(appl_type)
+
+            match_locations[location_id] = location_details
+
+        return match_locations
+
+    def get_all_devices(self):
+        """Determine available devices from inventory."""
+        return self._copy_details(self._get_topology()["devices"])
+
+    def _build_devices(self, appliances, thermo_locations, home_location, group_data):
+        """Determine available devices from inventory."""
+        devices = {}
+
+        for appliance, details in appliances.items():
+            loc_id = details["location"]
+            if loc_id is None:
+                details["location"] = home_location
+
+            # Override slave thermostat class
+            if loc_id in thermo_locations:
+                if "slaves" in thermo_locations[loc_id]:
+                    if appliance in thermo_locations[loc_id]["slaves"]:
+                        details["class"] = "thermo_sensor"
+
+            devices[appliance] = details
+
+        if group_data is not None:
+            devices.update(self._copy_details(group_data))
+
+        return devices
+
+    def get_group_switches(self):
+        """Provide switching- or pump-groups, from DOMAIN_OBJECTS."""
+        return self._copy_details(self._get_topology()["group_switches"])
+
+    def _build_group_switches(self):
+        """Provide switching- or pump-groups, from DOMAIN_OBJECTS."""
+        switch_groups = {}
+        search = self._domain_objects
+
+        group_members = self._get_groups(search)["members"]
+        groups = search.findall("./group")
+
+        for group in groups:
+            group_appl = {}
+            members = []
+            group_id = group.attrib["id"]
+            group_name = group.find("name").text
+            group_type = group.find("type").text
+            if self.smile_type == "stretch":
+                group_appliance = group.findall("appliances/appliance")
+                for dummy in group_appliance:
+                    members.append(dummy.attrib["id"])
+            else:
+                members = list(group_members.get(group_id, []))
+
+            if group_type in SWITCH_GROUP_TYPES:
+                group_appl[group_id] = {
+                    "name": group_name,
+                    "types": {"switch_group"},
+                    "class": group_type,
+                    "members": members,
+                    "location": None,
+                }
+
+            switch_groups.update(group_appl)
+
+        return switch_groups
+
+    def get_open_valves(self):
+        """Obtain the amount of open valves, from APPLIANCES."""
+        appliances = self._appliances.findall("appliance")
+        measurements = self._get_measurements(self._appliances).get("appliance", {})
+
+        open_valve_count = 0
+        for appliance in appliances:
+            found = measurements.get(
+                (appliance.attrib["id"], "point_log", "valve_position", None)
+            )
+            if found is not None:
+                measure, dummy = found
+                if float(measure) > 0.0:
+                    open_valve_count += 1
+
+        return open_valve_count
+
+    def get_all_device_data(self):
+        """Provide the device-data of all devices, collected in one pass."""
+        shared = {"locations": {}}
+        return {
+            dev_id: self._get_device_data(dev_id, details, shared)
+            for dev_id, details in self._get_topology()["devices"].items()
+        }
+
+    def get_changes(self):
+        """
+        Provide the device-data changed since the previous call.
+
+        Return changed ({dev_id: {key: new value}}, only holding the devices
+        and keys that changed), added ({dev_id: data}) and removed (dev_ids).
+        The first call reports all devices as added. Only the devices with
+        changed raw inputs (see _get_device_inputs) are extracted again.
+        """
+        shared = {"locations": {}}
+        previous = self._previous_device_data or {}
+        current = {}
+
+        changed = {}
+        added = {}
+        for dev_id, details in self._get_topology()["devices"].items():
+            inputs = self._get_device_inputs(dev_id, details, shared)
+            found = previous.get(dev_id)
+            if found is not None and found[0] == inputs:
+                current[dev_id] = found
+                continue
+
+            data = self._get_device_data(dev_id, details, shared)
+            current[dev_id] = (inputs, data)
+            if found is None:
+                added[dev_id] = copy.deepcopy(data)
+                continue
+
+            old_data = found[1]
+            device_changes = {
+                key: copy.deepcopy(value)
+                for key, value in data.items()
+                if key not in old_data or old_data[key] != value
+            }
+            # A key no longer present, i.e. a sensor that stopped reporting
+            for key in old_data.keys() - data.keys():
+                device_changes[key] = None
+            if device_changes:
+                changed[dev_id] = device_changes
+
+        self._previous_device_data = current
+        removed = [dev_id for dev_id in previous if dev_id not in current]
+        return changed, added, removed
+
+    def _get_device_inputs(self, dev_id, details, shared):
+        """
+        Collect the raw inputs of the device-data of a device, see get_changes.
+
+        These are the unformatted measurements of the objects a device reads,
+        and the (cached) preset- and schedule-data of its location.
+        """
+        search = self._appliances
+        if self._smile_legacy:
+            search = self._domain_objects
+        raw = self._get_raw_measurements(search)
+        domain_raw = self._get_raw_measurements(self._domain_objects)
+
+        inputs = [details, raw.get(("appliance", dev_id))]
+        if self.smile_name == "Adam" and details["class"] == "heater_central":
+            inputs.append((self.active_device_present, self.get_open_valves()))
+
+        if details["class"] in THERMOSTAT_CLASSES:
+            loc_id = details["location"]
+            if loc_id not in shared["locations"]:
+                shared["locations"][loc_id] = self._get_thermostat_data(loc_id)
+            inputs.append(shared["locations"][loc_id])
+
+        if details["class"] == "thermostat":
+            inputs.append(domain_raw.get(("appliance", dev_id)))
+
+        if details["class"] == "gateway" or dev_id == self.gateway_id:
+            inputs.append(self.gateway_id)
+            inputs.append(domain_raw.get(("location", self._home_location)))
+            inputs.append(domain_raw.get(("location", details["location"])))
+
+        if details["class"] in SWITCH_GROUP_TYPES:
+            members = details["members"]
+            inputs.append([raw.get(("appliance", member)) for member in members])
+
+        return inputs
+
+    def _get_snapshot(self):
+        """Provide a (devices, device_data) tuple of the current XML data."""
+        return self.get_all_devices(), self.get_all_device_data()
+
+    def get_device_data(self, dev_id):
+        """Provide device-data, based on location_id, from APPLIANCES."""
+        details = self._get_topology()["devices"].get(dev_id)
+        return self._get_device_data(dev_id, details, {"locations": {}})
+
+    def _get_device_data(self, dev_id, details, shared):
+        """
+        Provide device-data, based on location_id, from APPLIANCES.
+
+        Thermostat-location data is collected in shared, for reuse by the other
+        devices of the same pass.
+        """
+        device_data = self.get_appliance_data(dev_id)
+
+        # Legacy_anna: create  heating_state and leave out dhw_state
+        if "boiler_state" in device_data:
+            device_data["heating_state"] = device_data["intended_boiler_state"]
+            device_data.pop("boiler_state", None)
+            device_data.pop("intended_boiler_state", None)
+
+        # Fix for Adam + Anna: intended_central_heating_state also present under Anna, remove
+        if "setpoint" in device_data:
+            device_data.pop("heating_state", None)
+
+        # Adam: indicate heating_state based on valves being open in case of city-provided heating
+        if self.smile_name == "Adam": 
+            if details["class"] == "heater_central":
+                if not self.active_device_present:
+                    device_data["heating_state"] = True
+                    if self.get_open_valves() == 0:
+                        device_data["heating_state"] = False
+
+        # Anna, Lisa, Tom/Floor
+        if details["class"] in THERMOSTAT_CLASSES:
+            device_data.update(
+                self._get_shared_thermostat_data(details["location"], shared)
+            )
+
+        # Anna specific
+        if details["class"] in ["thermostat"]:
+            illuminance = self.get_object_value("appliance", dev_id, "illuminance")
+            if illuminance is not None:
+                device_data["illuminance"] = illuminance
+
+        # Generic
+        if details["class"] == "gateway" or dev_id == self.gateway_id:
+            # Anna: outdoor_temperature only present in domain_objects
+            if "outdoor_temperature" not in device_data:
+                outdoor_temperature = self.get_object_value(
+                    "location", self._home_location, "outdoor_temperature"
+                )
+                if outdoor_temperature is not None:
+                    device_data["outdoor_temperature"] = outdoor_temperature
+
+            # Try to get P1 data and 2nd outdoor_temperature, when present
+            power_data = self.get_power_data_from_location(details["location"])
+            if power_data is not None:
+                device_data.update(power_data)
+
+        ## Switching Groups
+        if details["class"] in SWITCH_GROUP_TYPES:
+            counter = 0
+            for member in details["members"]:
+                if self._get_relay_state(member):
+                    counter += 1
+
+            device_data["relay"] = True
+            if counter == 0:
+                device_data["relay"] = False
+
+        return device_data
+
+    def _get_relay_state(self, appl_id):
+        """Obtain the relay state of an appliance, False when unknown."""
+        search = self._appliances
+        if self._smile_legacy:
+            search = self._domain_objects
+
+        measurements = self._get_measurements(search).get("appliance", {})
+        found = measurements.get((appl_id, "point_log", "relay", None))
+        if found is None:
+            return False
+
+        measure, dummy = found
+        return bool(self._format_measure(measure))
+
+    def _get_shared_thermostat_data(self, loc_id, shared):
+        """Obtain the thermostat-data of a location, collected once per pass."""
+        if loc_id not in shared["locations"]:
+            shared["locations"][loc_id] = self._get_thermostat_data(loc_id)
+
+        # Don't share the presets and schedules lists between devices
+        data = {}
+        for key, value in shared["locations"][loc_id].items():
+            if isinstance(value, dict):
+                value = {name: list(setting) for name, setting in value.items()}
+            elif isinstance(value, list):
+                value = list(value)
+            data[key] = value
+
+        return data
+
+    def _get_thermostat_data(self, loc_id):
+        """Obtain the preset- and schedule-data of a thermostat location."""
+        data = {
+            "active_preset": self.get_preset(loc_id),
+            "presets": self.get_presets(loc_id),
+        }
+
+        avail_schemas, sel_schema, sched_setpoint = self.get_schemas(loc_id)
+        if not self._smile_legacy:
+            data["schedule_temperature"] = sched_setpoint
+        data["available_schedules"] = avail_schemas
+        data["selected_schedule"] = sel_schema
+        if self._smile_legacy:
+            data["last_used"] = "".join(map(str, avail_schemas))
+        else:
+            data["last_used"] = self.get_last_active_schema(loc_id)
+
+        return data
+
+    def get_appliance_data(self, dev_id):
+        """
+        Obtain the appliance-data connected to a location.
+
+        Determined from APPLIANCES or legacy DOMAIN_OBJECTS.
+        """
+        data = {}
+        search = self._appliances
+
+        if self._smile_legacy:
+            search = self._domain_objects
+
+        measurements = self._get_measurements(search).get("appliance", {})
+
+        for measurement, name in DEVICE_MEASUREMENTS.items():
+
+            found = measurements.get((dev_id, "point_log", measurement, None))
+            if found is not None:
+                if self._smile_legacy:
+                    if measurement == "domestic_hot_water_state":
+                        continue
+
+                measure, dummy = found
+                # Fix for Adam + Anna: there is a pressure-measurement with an unrealistic value,
+                # this measurement appears at power-on and is never updated, therefore remove.
+                if (
+                    measurement == "central_heater_water_pressure"
+                    and float(measure) > 3.5
+                ):
+                    continue
+                # The presence of either indicates a local active device, e.g. heat-pump or gas-fired heater
+                if (
+                    measurement == "compressor_state" 
+                    or measurement == "flame_state"
+                ):
+                    self.active_device_present = True
+
+                data[name] = self._format_measure(measure)
+
+            found = measurements.get((dev_id, "interval_log", measurement, None))
+            if found is not None:
+                name = f"{name}_interval"
+                measure, dummy = found
+
+                data[name] = self._format_measure(measure)
+
+            found = measurements.get((dev_id, "cumulative_log", measurement, None))
+            if found is not None:
+                name = f"{name}_cumulative"
+                measure, dummy = found
+
+                data[name] = self._format_measure(measure)
+
+        return data
+
+    @staticmethod
+    @lru_cache(maxsize=MEASURE_CACHE_SIZE)
+    def _format_measure(measure):
+        """Format measure to correct type."""
+        try:
+            measure = int(measure)
+        except ValueError:
+            try:
+                if float(measure) < 10:
+                    measure = float(f"{round(float(measure), 2):.2f}")
+                elif float(measure) >= 10 and float(measure) < 100:
+                    measure = float(f"{round(float(measure), 1):.1f}")
+                elif float(measure) >= 100:
+                    measure = int(round(float(measure)))
+            except ValueError:
+                if measure == "on":
+                    measure = True
+                elif measure == "off":
+                    measure = False
+        return measure
+
+    def _get_tree_index(self, search):
+        """
+        Return the indexes of a retrieved XML tree.
+
+        Each index is built once for each tree, kept until the tree is replaced
+        by an update.
+        """
+        for tree, index in self._tree_indexes:
+            if tree is search:
+                return index
+
+        index = {}
+        current = (self._appliances, self._domain_objects, self._locations)
+        self._tree_indexes = [
+            (tree, tree_index)
+            for tree, tree_index in self._tree_indexes
+            if any(tree is xml for xml in current)
+        ]
+        self._tree_indexes.append((search, index))
+        return index
+
+    def _get_elements(self, search):
+        """Return the element index of a retrieved XML tree."""
+        index = self._get_tree_index(search)
+        if "elements" not in index:
+            index["elements"] = self._index_elements(search)
+        return index["elements"]
+
+    def _get_element(self, search, obj_type, obj_id):
+        """Obtain the object (i.e. a location or rule) with obj_id, or None."""
+        return self._get_elements(search).get(obj_type, {}).get(obj_id)
+
+    @staticmethod
+    def _index_elements(search):
+        """Return {object type: {object id: element}} of the objects in the tree."""
+        elements = {}
+        if search is None:
+            return elements
+
+        for element in search.iterchildren("*"):
+            obj_id = element.get("id")
+            if obj_id is not None:
+                elements.setdefault(element.tag, {}).setdefault(obj_id, element)
+
+        return elements
+
+    def _get_rules(self, search):
+        """Return the rule index of a retrieved XML tree."""
+        index = self._get_tree_index(search)
+        if "rules" not in index:
+            index["rules"] = self._index_rules(search)
+        return index["rules"]
+
+    @staticmethod
+    def _index_rules(search):
+        """
+        Collect the rules with their template tags and (zone) locations.
+
+        Return {"rules": {rule_id: details}, "tags": {(tag, loc_id): rule_ids},
+        "names": {(name, loc_id): rule_ids}}, with rule_ids {rule_id: loc_id}.
+        """
+        rules = {"rules": {}, "tags": {}, "names": {}}
+        if search is None:
+            return rules
+
+        for rule in search.iter("rule"):
+            rule_id = rule.get("id")
+            name = rule.findtext("name")
+            if rule_id not in rules["rules"]:
+                template_id = None
+                for template in rule.findall("template"):
+                    template_id = template.get("id")
+
+                modified_date = rule.findtext("modified_date")
+                if modified_date:
+                    modified_date = parse_timestamp(modified_date)
+
+                directives = rule.find("directives")
+                if directives is not None:
+                    directives = [
+                        (dict(directive.attrib), dict(directive.find("then").attrib))
+                        for directive in directives
+                        if directive.find("then") is not None
+                    ]
+
+                rules["rules"][rule_id] = {
+                    "name": name,
+                    "active": rule.findtext("active") == "true",
+                    "template": template_id,
+                    "modified_date": modified_date,
+                    "directives": directives,
+                }
+
+            tags = {
+                template.attrib["tag"]
+                for template in rule.iterfind(".//template[@tag]")
+            }
+            for location in rule.iterfind(".//contexts/context/zone/location[@id]"):
+                loc_id = location.attrib["id"]
+                for tag in tags:
+                    rules["tags"].setdefault((tag, loc_id), {})[rule_id] = loc_id
+                rules["names"].setdefault((name, loc_id), {})[rule_id] = loc_id
+
+        return rules
+
+    def _get_groups(self, search):
+        """Return the group membership index of a retrieved XML tree."""
+        index = self._get_tree_index(search)
+        if "groups" not in index:
+            index["groups"] = self._index_groups(search)
+        return index["groups"]
+
+    @staticmethod
+    def _index_groups(search):
+        """
+        Collect the group memberships registered at the appliances, in one pass.
+
+        Return {"groups": {appliance id: group id}, "members": {group id:
+        appliance ids}}. Only the first group of an appliance is taken.
+        """
+        groups = {"groups": {}, "members": {}}
+        if search is None:
+            return groups
+
+        for appliance in search.findall("appliance"):
+            group = appliance.find("groups/group")
+            if group is not None:
+                appl_id = appliance.attrib["id"]
+                group_id = group.attrib["id"]
+                groups["groups"][appl_id] = group_id
+                groups["members"].setdefault(group_id, []).append(appl_id)
+
+        return groups
+
+    def _get_measurements(self, search):
+        """Return the measurement index of a retrieved XML tree."""
+        index = self._get_tree_index(search)
+        if "measurements" not in index:
+            self._build_measurement_index(search, index)
+        return index["measurements"]
+
+    def _get_raw_measurements(self, search):
+        """
+        Return the raw measurements per object of a retrieved XML tree.
+
+        Return {(object type, object id): [measurements of each log]}, see
+        _read_log, to compare the inputs of the device-data.
+        """
+        index = self._get_tree_index(search)
+        if "measurements" not in index:
+            self._build_measurement_index(search, index)
+        return index["raw"]
+
+    def _build_measurement_index(self, search, index):
+        """Add the measurement indexes of a retrieved XML tree to its index."""
+        logs = None
+        if self._incremental_extraction and search is not None:
+            # The previous logs of the same endpoint, see _index_measurements
+            logs = self._measured_logs.get(search.tag, {})
+
+        measurements, raw, logs = self._index_measurements(search, logs)
+        index["measurements"] = measurements
+        index["raw"] = raw
+        if logs is not None:
+            self._measured_logs[search.tag] = logs
+
+    @staticmethod
+    def _index_measurements(search, logs=None):
+        """
+        Collect all logged measurements of the objects in one pass over the tree.
+
+        Return {object type: {(object id, log type, measurement, tariff): value}},
+        with value the tuple (raw measurement, updated_date of the log). Tariff None
+        refers to the first measurement of a log, regardless of its tariff.
+        Also return the measurements of the logs per object, see
+        _get_raw_measurements.
+        With logs ({log: (updated_date, measurements)} of the previous tree) the
+        measurements of a log with the same updated_date are reused, the new
+        logs are returned as well (otherwise None).
+        """
+        measurements = {}
+        objects = {}
+        new_logs = None if logs is None else {}
+        if search is None:
+            return measurements, objects, new_logs
+
+        for obj_logs in search.iter("logs"):
+            obj = obj_logs.getparent()
+            obj_measurements = measurements.setdefault(obj.tag, {})
+            obj_id = obj.get("id")
+            obj_logs_measurements = objects.setdefault((obj.tag, obj_id), [])
+            for log in obj_logs:
+                updated_date = log.findtext("updated_date")
+                if logs is not None and updated_date:
+                    log_key = (obj.tag, obj_id, log.get("id"))
+                    found = logs.get(log_key)
+                    if found is None or found[0] != updated_date:
+                        found = (updated_date, SmileState._read_log(obj_id, log))
+                    new_logs[log_key] = found
+                    log_measurements = found[1]
+                else:
+                    log_measurements = SmileState._read_log(obj_id, log)
+
+                obj_logs_measurements.append(log_measurements)
+                for key, value in log_measurements:
+                    obj_measurements.setdefault(key, value)
+
+        return measurements, objects, new_logs
+
+    @staticmethod
+    def _read_log(obj_id, log):
+        """Return the ((object id, log type, measurement, tariff), value) of a log."""
+        log_measurements = []
+        log_type = log.tag
+        measurement = log.findtext("type")
+        updated_date = log.findtext("updated_date")
+        if updated_date:
+            updated_date = parse_timestamp(updated_date)
+        for measure in log.iterfind("period/measurement"):
+            value = (measure.text, updated_date)
+            tariff = measure.get("tariff", measure.get("tariff_indicator"))
+            log_measurements.append(((obj_id, log_type, measurement, None), value))
+            log_measurements.append(((obj_id, log_type, measurement, tariff), value))
+
+        return log_measurements
+
+    def get_power_data_from_location(self, loc_id):
+        """Obtain the power-data from domain_objects based on location."""
+        direct_data = {}
+        measurements = self._get_measurements(self._domain_objects).get("location", {})
+
+        log_list = ["point_log", "cumulative_log", "interval_log"]
+        peak_list = ["nl_peak", "nl_offpeak"]
+
+        # meter_string = ".//{}[type='{}']/"
+        for measurement in HOME_MEASUREMENTS:
+            for log_type in log_list:
+                for peak_select in peak_list:
+                    found = measurements.get(
+                        (loc_id, log_type, measurement, peak_select)
+                    )
+                    # Only once try to find P1 Legacy values
+                    if found is None and self.smile_type == "power":
+                        found = measurements.get((loc_id, log_type, measurement, None))
+
+                        # Skip peak if not split (P1 Legacy)
+                        if peak_select == "nl_offpeak":
+                            continue
+
+                    if found is None:
+                        continue
+
+                    peak = peak_select.split("_")[1]
+                    if peak == "offpeak":
+                        peak = "off_peak"
+                    log_found = log_type.split("_")[0]
+                    key_string = f"{measurement}_{peak}_{log_found}"
+                    net_string = f"net_electricity_{log_found}"
+                    val, dummy = found
+                    f_val = self._format_measure(val)
+                    if "gas" in measurement:
+                        key_string = f"{measurement}_{log_found}"
+                        f_val = float(f"{round(float(val), 3):.3f}")
+
+                    # Energy differential
+                    if "electricity" in measurement:
+                        f_val = float(f"{round(float(val), 1):.1f}")
+                        diff = 1
+                        if "produced" in measurement:
+                            diff = -1
+                        if net_string not in direct_data:
+                            direct_data[net_string] = float()
+                        direct_data[net_string] += float(f_val * diff)
+
+                    direct_data[key_string] = f_val
+
+        if direct_data != {}:
+            return direct_data
+
+    def get_preset(self, loc_id):
+        """
+        Obtain the active preset based on the location_id.
+
+        Determined from DOMAIN_OBJECTS.
+        """
+        if self._smile_legacy:
+            active_rule = self._domain_objects.find(
+                "rule[active='true']/directives/when/then"
+            )
+            if active_rule is None or "icon" not in active_rule.keys():
+                return
+            return active_rule.attrib["icon"]
+
+        location = self._get_element(self._domain_objects, "location", loc_id)
+        if location is not None and location.find("preset") is not None:
+            return location.find("preset").text
+
+    def get_presets(self, loc_id):
+        """Get the presets from the thermostat based on location_id."""
+        return {
+            preset: list(setpoints)
+            for preset, setpoints in self._get_presets(loc_id).items()
+        }
+
+    def _get_presets(self, loc_id):
+        """
+        Return the presets of a location as an immutable mapping.
+
+        Kept per location, until the modified_date of one of its preset rules changes.
+        """
+        tag = "zone_setpoint_and_state_based_on_preset"
+        rules = self._get_rules(self._domain_objects)["rules"]
+
+        if self._smile_legacy:
+            rule_ids = rules
+        else:
+            rule_ids = self.get_rule_ids_by_tag(tag, loc_id)
+            if rule_ids is None:
+                rule_ids = self.get_rule_ids_by_name("Thermostat presets", loc_id)
+                if rule_ids is None:
+                    rule_ids = {}
+
+        modified = tuple(
+            (rule_id, rules[rule_id]["modified_date"]) for rule_id in rule_ids
+        )
+        cached = self._presets.get(loc_id)
+        if cached is not None and cached[0] == modified:
+            return cached[1]
+
+        if self._smile_legacy:
+            presets = self.__get_presets_legacy()
+        else:
+            presets = self.__get_presets(rule_ids)
+
+        presets = MappingProxyType(
+            {preset: tuple(setpoints) for preset, setpoints in presets.items()}
+        )
+        self._presets[loc_id] = (modified, presets)
+        return presets
+
+    def __get_presets(self, rule_ids):
+        """Get the presets from the directives of the given preset rules."""
+        presets = {}
+        rules = self._get_rules(self._domain_objects)["rules"]
+        for rule_id in rule_ids:
+            for directive, preset in rules[rule_id]["directives"]:
+                keys, dummy = zip(*preset.items())
+                if str(keys[0]) == "setpoint":
+                    presets[directive["preset"]] = [float(preset["setpoint"]), 0]
+                else:
+                    presets[directive["preset"]] = [
+                        float(preset["heating_setpoint"]),
+                        float(preset["cooling_setpoint"]),
+                    ]
+
+        return presets
+
+    def get_schemas(self, loc_id):
+        """Obtain the available schemas or schedules based on the location_id."""
+        rule_ids = {}
+        schemas = {}
+        available = []
+        selected = None
+        schedule_temperature = None
+
+        # Legacy schemas
+        if self._smile_legacy:  # Only one schedule allowed
+            name = None
+            for schema in self._domain_objects.findall(".//rule"):
+                rule_name = schema.find("name").text
+                if rule_name:
+                    if "preset" not in rule_name:
+                        name = rule_name
+
+            log_type = "schedule_state"
+            locator = f"appliance[type='thermostat']/logs/point_log[type='{log_type}']/period/measurement"
+            active = False
+            if self._domain_objects.find(locator) is not None:
+                active = self._domain_objects.find(locator).text == "on"
+
+            if name is not None:
+                schemas[name] = active
+
+            available, selected = self.determine_selected(available, selected, schemas)
+
+            return available, selected, schedule_temperature
+
+        # Current schemas
+        tag = "zone_preset_based_on_time_and_presence_with_override"
+        rule_ids = self.get_rule_ids_by_tag(tag, loc_id)
+
+        if rule_ids is None:
+            return available, selected, schedule_temperature
+
+        rules = self._get_rules(self._domain_objects)["rules"]
+        minute = self._minute_of_week(dt.datetime.now())
+        for rule_id, dummy in rule_ids.items():
+            name = rules[rule_id]["name"]
+            schemas[name] = rules[rule_id]["active"]
+            if rules[rule_id]["directives"] is None:
+                return available, selected, schedule_temperature
+
+            # The last matching period of the last matching schedule applies
+            timeline = self._get_schedule_timeline(rule_id, loc_id)
+            setpoint = self._get_timeline_setpoint(timeline, minute)
+            if setpoint is not None:
+                schedule_temperature = setpoint
+
+        available, selected = self.determine_selected(available, selected, schemas)
+
+        return available, selected, schedule_temperature
+
+    def get_schedule_next_change(self, loc_id, moment=None):
+        """
+        Determine the next change of the schedule_temperature of a location.
+
+        Return (moment of the change, new schedule_temperature) after moment
+        (default now), None when the schedules never change it.
+        """
+        if self._smile_legacy:
+            return None
+
+        if moment is None:
+            moment = dt.datetime.now()
+
+        tag = "zone_preset_based_on_time_and_presence_with_override"
+        rule_ids = self.get_rule_ids_by_tag(tag, loc_id)
+        if rule_ids is None:
+            return None
+
+        timeline = self._get_location_timeline(rule_ids, loc_id)
+        if timeline is None:
+            return None
+
+        minutes, setpoints = timeline
+        minute = self._minute_of_week(moment)
+        index = bisect.bisect_right(minutes, minute) - 1
+        current = setpoints[index]
+        # The timeline only holds changes, except at the start of the week
+        for step in range(1, len(minutes) + 1):
+            change = index + step
+            setpoint = setpoints[change % len(minutes)]
+            if setpoint != current:
+                change = minutes[change % len(minutes)] + (
+                    change // len(minutes) * MINUTES_PER_WEEK
+                )
+                start = moment.replace(second=0, microsecond=0)
+                return start + dt.timedelta(minutes=change - minute), setpoint
+
+        return None
+
+    def _get_location_timeline(self, rule_ids, loc_id):
+        """
+        Return the timeline of the schedule_temperature of a location.
+
+        Merges the timelines of its schedule rules, the last rule with a setpoint
+        applies, see get_schemas. None when a rule has no directives.
+        """
+        rules = self._get_rules(self._domain_objects)["rules"]
+        timelines = []
+        for rule_id in rule_ids:
+            if rules[rule_id]["directives"] is None:
+                return None
+            timelines.append(self._get_schedule_timeline(rule_id, loc_id))
+
+        cached = self._location_timelines.get(loc_id)
+        if cached is not None and len(cached[0]) == len(timelines):
+            if all(old is new for old, new in zip(cached[0], timelines)):
+                return cached[1]
+
+        minutes = []
+        setpoints = []
+        bounds = {0}
+        for timeline in timelines:
+            bounds.update(timeline[0])
+        for bound in sorted(bounds):
+            setpoint = None
+            for timeline in timelines:
+                found = self._get_timeline_setpoint(timeline, bound)
+                if found is not None:
+                    setpoint = found
+            # Only keep the changes
+            if not minutes or setpoint != setpoints[-1]:
+                minutes.append(bound)
+                setpoints.append(setpoint)
+
+        self._location_timelines[loc_id] = (timelines, (minutes, setpoints))
+        return minutes, setpoints
+
+    def _get_schedule_timeline(self, rule_id, loc_id):
+        """Return the compiled timeline of a schedule rule, compile when changed."""
+        rules = self._get_rules(self._domain_objects)["rules"]
+        if rules is not self._schedule_rules:
+            # New rules, forget the timelines of the removed ones
+            for removed in self._schedule_timelines.keys() - rules.keys():
+                del self._schedule_timelines[removed]
+            self._schedule_rules = rules
+
+        rule = rules[rule_id]
+        presets = self._get_presets(loc_id)
+
+        cached = self._schedule_timelines.get(rule_id)
+        if cached is not None:
+            modified_date, cached_presets, timeline = cached
+            if modified_date == rule["modified_date"] and cached_presets == presets:
+                return timeline
+
+        schedules = {}
+        for directive, schedule in rule["directives"]:
+            keys, dummy = zip(*schedule.items())
+            if str(keys[0]) == "preset":
+                schedules[directive["time"]] = float(presets[schedule["preset"]][0])
+            else:
+                schedules[directive["time"]] = float(schedule["setpoint"])
+
+        timeline = self._compile_schedule(schedules)
+        self._schedule_timelines[rule_id] = (rule["modified_date"], presets, timeline)
+        return timeline
+
+    @staticmethod
+    def _compile_schedule(schedules):
+        """
+        Compile the {period: setpoint} schedules into a weekly timeline.
+
+        Return (minutes, setpoints): setpoints[i] applies from minute of the week
+        minutes[i] until the next entry, None outside the periods. A period
+        applies on both its start and end day, between its start and end time.
+        When periods overlap the last one applies.
+        """
+        spans = []
+        for period, setpoint in schedules.items():
+            moment_1, moment_2 = period.split(",")
+            moment_1 = moment_1.replace("[", "").split(" ")
+            moment_2 = moment_2.replace(")", "").split(" ")
+            start = dt.datetime.strptime(moment_1[1], "%H:%M")
+            end = dt.datetime.strptime(moment_2[1], "%H:%M")
+            start = start.hour * 60 + start.minute
+            end = end.hour * 60 + end.minute
+
+            day_spans = [(start, end)]
+            if start > end:
+                day_spans = [(0, end), (start, MINUTES_PER_DAY)]
+            for day in {SCHEDULE_DAYS.get(moment_1[0]), SCHEDULE_DAYS.get(moment_2[0])}:
+                if day is None:
+                    continue
+                for span_start, span_end in day_spans:
+                    if span_start < span_end:
+                        offset = day * MINUTES_PER_DAY
+                        spans.append((offset + span_start, offset + span_end, setpoint))
+
+        bounds = {0}
+        for span_start, span_end, dummy in spans:
+            bounds.update((span_start, span_end % MINUTES_PER_WEEK))
+
+        minutes = []
+        setpoints = []
+        for bound in sorted(bounds):
+            setpoint = None
+            for span_start, span_end, span_setpoint in spans:
+                if span_start <= bound < span_end:
+                    setpoint = span_setpoint
+            # Only keep the changes
+            if not minutes or setpoint != setpoints[-1]:
+                minutes.append(bound)
+                setpoints.append(setpoint)
+
+        return minutes, setpoints
+
+    @staticmethod
+    def _get_timeline_setpoint(timeline, minute):
+        """Return the setpoint of a compiled timeline at a minute of the week."""
+        minutes, setpoints = timeline
+        return setpoints[bisect.bisect_right(minutes, minute) - 1]
+
+    @staticmethod
+    def _minute_of_week(moment):
+        """Return the minute of the week (from monday 00:00) of a datetime."""
+        return moment.weekday() * MINUTES_PER_DAY + moment.hour * 60 + moment.minute
+
+    @staticmethod
+    def determine_selected(available, selected, schemas):
+        """Determine selected schema from available schemas."""
+        for schema_a, schema_b in schemas.items():
+            available.append(schema_a)
+            if schema_b:
+                selected = schema_a
+
+        return available, selected
+
+    @staticmethod
+    def in_between(now, start, end):
+        """Determine timing for schedules."""
+        if start <= end:
+            return start <= now < end
+        return start <= now or now < end
+
+    def get_last_active_schema(self, loc_id):
+        """Determine the last active schema."""
+        rule_ids = {}
+        schemas = {}
+        last_modified = None
+
+        tag = "zone_preset_based_on_time_and_presence_with_override"
+
+        rule_ids = self.get_rule_ids_by_tag(tag, loc_id)
+        if rule_ids is None:
+            return
+
+        rules = self._get_rules(self._domain_objects)["rules"]
+        for rule_id, dummy in rule_ids.items():
+            schema_name = rules[rule_id]["name"]
+            schema_time = rules[rule_id]["modified_date"]
+            schemas[schema_name] = schema_time.timestamp()
+
+        if schemas != {}:
+            last_modified = sorted(schemas.items(), key=lambda kv: kv[1])[-1][0]
+
+        return last_modified
+
+    def get_rule_ids_by_tag(self, tag, loc_id):
+        """Obtain the rule_id based on the given template_tag and location_id."""
+        schema_ids = self._get_rules(self._domain_objects)["tags"].get((tag, loc_id))
+        if schema_ids:
+            return dict(schema_ids)
+
+    def get_rule_ids_by_name(self, name, loc_id):
+        """Obtain the rule_id on the given name and location_id."""
+        schema_ids = self._get_rules(self._domain_objects)["names"].get((name, loc_id))
+        if schema_ids:
+            return dict(schema_ids)
+
+    def get_object_value(self, obj_type, obj_id, measurement):
+        """Obtain the object-value from the thermostat."""
+        measurements = self._get_measurements(self._domain_objects).get(obj_type, {})
+
+        found = measurements.get((obj_id, "point_log", measurement, None))
+        if found is not None:
+            val, dummy = found
+            return self._format_measure(val)
+
+        return None
+
+    def _repair_xml(self, xmldata, command):
+        """Replace illegal &-characters in (a part of) a response, count repairs."""
+        repaired = self.escape_illegal_xml_characters(xmldata)
+        if repaired is not xmldata:
+            # Every repair inserts "amp;"
+            count = (len(repaired) - len(xmldata)) // 4
+            self.xml_repairs += count
+            _LOGGER.debug("Repaired %s illegal &-characters in %s", count, command)
+
+        return repaired
+
+    @staticmethod
+    def escape_illegal_xml_characters(xmldata):
+        """Replace illegal &-characters, unchanged xmldata is returned as is."""
+        if isinstance(xmldata, str):
+            return SmileState.escape_illegal_xml_characters(xmldata.encode()).decode()
+
+        if b"&" not in xmldata or ILLEGAL_AMPERSAND.search(xmldata) is None:
+            return xmldata
+        return ILLEGAL_AMPERSAND.sub(rb"&amp;\1", xmldata)
+
+    # LEGACY Anna functions
+
+    def __get_presets_legacy(self):
+        """Get presets from domain_objects for legacy Smile."""
+        preset_dictionary = {}
+        for directive in self._domain_objects.findall("rule/directives/when/then"):
+            if directive is not None and "icon" in directive.keys():
+                # Ensure list of heating_setpoint, cooling_setpoint
+                preset_dictionary[directive.attrib["icon"]] = [
+                    float(directive.attrib["temperature"]),
+                    0,
+                ]
+
+        return preset_dictionary
+
+    class PlugwiseError(Exception):
+        """Plugwise exceptions class."""
+
+    class ConnectionFailedError(PlugwiseError):
+        """Raised when unable to connect."""
+
+    class InvalidAuthentication(PlugwiseError):
+        """Raised when unable to authenticate."""
+
+    class UnsupportedDeviceError(PlugwiseError):
+        """Raised when device is not supported."""
+
+    class DeviceSetupError(PlugwiseError):
+        """Raised when device is missing critical setup data."""
+
+    class DeviceTimeoutError(PlugwiseError):
+        """Raised when device is not supported."""
+
+    class CircuitOpenError(DeviceTimeoutError):
+        """Raised when not contacting a device after repeated timeouts."""
+
+    class ErrorSendingCommandError(PlugwiseError):
+        """Raised when device is not accepting the command."""
+
+    class ResponseError(PlugwiseError):
+        """Raised when empty or error in response returned."""
+
+    class InvalidXMLError(PlugwiseError):
+        """Raised when response holds incomplete or invalid XML data."""
+
+    class XMLDataMissingError(PlugwiseError):
+        """Raised when xml data is empty."""
@@ -0,0 +1,174 @@
+"""Plugwise Smile transport helpers."""
+
+import random
+import time
+
+import aiohttp
+
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 0.5
+DEFAULT_MAX_BACKOFF = 10.0
+
+# Gateway is (temporarily) too busy to handle the request
+RETRY_STATUSES = (502, 503)
+
+# Repeating these results in the same state on the Smile
+IDEMPOTENT_METHODS = ("get", "put", "delete")
+
+DEFAULT_FAILURE_THRESHOLD = 3
+DEFAULT_RESET_TIMEOUT = 60
+
+# Connection pool, embedded gateways handle only a few connections at a time
+DEFAULT_POOL_LIMIT = 100
+DEFAULT_POOL_LIMIT_PER_HOST = 2
+DEFAULT_KEEPALIVE_TIMEOUT = 30
+DEFAULT_DNS_CACHE_TTL = 300
+
+CIRCUIT_CLOSED = "closed"
+CIRCUIT_OPEN = "open"
+CIRCUIT_HALF_OPEN = "half_open"
+
+
+class RetryPolicy:
+    """Define when, and after which delay, a failed request is retried."""
+
+    def __init__(
+        self,
+        retries=None,
+        backoff=DEFAULT_BACKOFF,
+        max_backoff=DEFAULT_MAX_BACKOFF,
+        jitter=True,
+        retry_statuses=RETRY_STATUSES,
+        idempotent_methods=IDEMPOTENT_METHODS,
+    ):
+        """
+        Set the constructor for this class.
+
+        retries: amount of retries per (lower case) method, i.e. {"put": 1}
+        backoff: delay before the first retry, doubled for every next retry
+        jitter: pick a random delay up to the backoff to spread out retries
+        """
+        self.retries = {method: DEFAULT_RETRIES for method in IDEMPOTENT_METHODS}
+        if retries is not None:
+            self.retries.update(retries)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.retry_statuses = set(retry_statuses)
+        self.idempotent_methods = set(idempotent_methods)
+
+    def retries_for(self, method, idempotent=None):
+        """Return the amount of retries allowed for a request."""
+        if idempotent is None:
+            idempotent = method in self.idempotent_methods
+        # Never repeat a write that might have been handled already
+        if not idempotent:
+            return 0
+
+        return self.retries.get(method, 0)
+
+    def retry_on_status(self, status):
+        """Determine if a response with this status should be retried."""
+        return status in self.retry_statuses
+
+    def delay(self, attempt):
+        """Return the delay in seconds before retry number attempt (from 0)."""
+        delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+        if self.jitter:
+            return random.uniform(0, delay)
+
+        return delay
+
+
+class CircuitBreaker:
+    """Stop sending requests to a Smile that repeatedly fails to respond."""
+
+    def __init__(
+        self,
+        failure_threshold=DEFAULT_FAILURE_THRESHOLD,
+        reset_timeout=DEFAULT_RESET_TIMEOUT,
+    ):
+        """
+        Set the constructor for this class.
+
+        failure_threshold: consecutive failed requests before opening the circuit
+        reset_timeout: seconds to fail fast before probing the Smile again
+        """
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        """Return closed, open or half_open (i.e. a probe is due)."""
+        if self._opened_at is None:
+            return CIRCUIT_CLOSED
+        if self._probing or time.monotonic() - self._opened_at < self.reset_timeout:
+            return CIRCUIT_OPEN
+        return CIRCUIT_HALF_OPEN
+
+    def start_probe(self):
+        """Claim the probe of a half-open circuit, False when no probe is due."""
+        if self.state != CIRCUIT_HALF_OPEN:
+            return False
+
+        self._probing = True
+        return True
+
+    def record_success(self):
+        """Close the circuit, the Smile responded."""
+        self.failures = 0
+        self._opened_at = None
+        self._probing = False
+
+    def record_failure(self):
+        """Count a failed request, (re)open the circuit when needed."""
+        self.failures += 1
+        self._probing = False
+        if self._opened_at is not None or self.failures >= self.failure_threshold:
+            self._opened_at = time.monotonic()
+
+
+class SharedTransport:
+    """Share one connection pool (aiohttp session) between many Smiles."""
+
+    def __init__(
+        self,
+        limit=DEFAULT_POOL_LIMIT,
+        limit_per_host=DEFAULT_POOL_LIMIT_PER_HOST,
+        keepalive_timeout=DEFAULT_KEEPALIVE_TIMEOUT,
+        ttl_dns_cache=DEFAULT_DNS_CACHE_TTL,
+    ):
+        """Set the constructor for this class, the session is created on first use."""
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.ttl_dns_cache = ttl_dns_cache
+        self.users = 0
+        self._session = None
+
+    def acquire(self):
+        """Register a Smile using this transport."""
+        self.users += 1
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """Return the shared session, create it when needed."""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.ttl_dns_cache,
+            )
+            self._session = aiohttp.ClientSession(connector=connector)
+
+        return self._session
+
+    async def release(self):
+        """Unregister a Smile, close the session when it was the last user."""
+        self.users = max(0, self.users - 1)
+        if self.users == 0 and self._session is not None:
+            await self._session.close()
+            self._session = None
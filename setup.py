@@ -35,8 +35,6 @@ setup(
         "aiohttp",
         "async_timeout",
         "lxml",
-        "pytz",
-        "python-dateutil",
         "semver",
     ],
     zip_safe=False,
@@ -5,16 +5,27 @@ from pprint import PrettyPrinter
 # Testing
 import aiohttp
 import asyncio
+import concurrent.futures
+import datetime as dt
 import logging
 import pytest
 
 # Fixture writing
 import io
+import json as json_lines
 import os
+import pickle
+import subprocess
+import sys
 
 import jsonpickle as json
+from lxml import etree
 
-from Plugwise_Smile.Smile import Smile
+from Plugwise_Smile import batch
+from Plugwise_Smile.fleet import SmileFleet
+from Plugwise_Smile.Smile import Smile, parse_timestamp
+from Plugwise_Smile.state import SmileState
+from Plugwise_Smile.transport import CircuitBreaker, RetryPolicy, SharedTransport
 
 pp = PrettyPrinter(indent=8)
 
@@ -134,7 +145,15 @@ class TestPlugwise:
         """Render server error endpoint."""
         raise aiohttp.web.HTTPInternalServerError(text="Internal Server Error")
 
-    async def connect(self, broken=False, timeout=False, put_timeout=False):
+    async def connect(
+        self,
+        broken=False,
+        timeout=False,
+        put_timeout=False,
+        max_concurrent_requests=1,
+        domain_objects_only=False,
+        executor_mode=False,
+    ):
         """Connect to a smile environment and perform basic asserts."""
         port = aiohttp.test_utils.unused_port()
 
@@ -171,6 +190,9 @@ class TestPlugwise:
             password="abcdefgh",
             port=server.port,
             websession=websession,
+            max_concurrent_requests=max_concurrent_requests,
+            domain_objects_only=domain_objects_only,
+            executor_mode=executor_mode,
         )
 
         if not timeout:
@@ -183,21 +205,32 @@ class TestPlugwise:
             connection_state = await smile.connect()
             assert connection_state
             assert smile.smile_type is not None
+            assert "full_update" in smile.startup_timing
             return server, smile, client
         except (Smile.DeviceTimeoutError, Smile.InvalidXMLError) as e:
             await self.disconnect(server, client)
             raise e
 
     # Wrap connect for invalid connections
-    async def connect_wrapper(self, put_timeout=False):
+    async def connect_wrapper(
+        self, put_timeout=False, max_concurrent_requests=1, domain_objects_only=False
+    ):
         """Wrap connect to try negative testing before positive testing."""
+        options = {
+            "max_concurrent_requests": max_concurrent_requests,
+            "domain_objects_only": domain_objects_only,
+        }
+        if domain_objects_only:
+            # Locations are not requested, skip the (broken) locations tests
+            return await self.connect(put_timeout=put_timeout, **options)
+
         if put_timeout:
             _LOGGER.warning("Connecting to device exceeding timeout in handling:")
-            return await self.connect(put_timeout=True)
+            return await self.connect(put_timeout=True, **options)
 
         try:
             _LOGGER.warning("Connecting to device exceeding timeout in response:")
-            await self.connect(timeout=True)
+            await self.connect(timeout=True, **options)
             _LOGGER.error(" - timeout not handled")
             raise self.ConnectError
         except (Smile.DeviceTimeoutError, Smile.ResponseError):
@@ -205,14 +238,14 @@ class TestPlugwise:
 
         try:
             _LOGGER.warning("Connecting to device with missing data:")
-            await self.connect(broken=True)
+            await self.connect(broken=True, **options)
             _LOGGER.error(" - broken information not handled")
             raise self.ConnectError
         except Smile.InvalidXMLError:
             _LOGGER.info(" + succesfully passed XML issue handling.")
 
         _LOGGER.info("Connecting to functioning device:")
-        return await self.connect()
+        return await self.connect(**options)
 
     # Generic disconnect
     @pytest.mark.asyncio
@@ -221,6 +254,22 @@ class TestPlugwise:
         await client.session.close()
         await server.close()
 
+    @staticmethod
+    def load_state(setup, smile_type="thermostat", smile_name="Adam"):
+        """Derive a SmileState from the XML documents of a setup, without a server."""
+        documents = {}
+        for name in ["appliances", "domain_objects", "locations"]:
+            with open(f"tests/{setup}/core.{name}.xml", "rb") as xml:
+                documents[name] = xml.read()
+        state = SmileState.from_documents(
+            documents["appliances"],
+            documents["domain_objects"],
+            documents["locations"],
+            smile_type,
+            smile_name=smile_name,
+        )
+        return state, documents
+
     @staticmethod
     def show_setup(location_list, device_list):
         """Show informative outline of the setup."""
@@ -257,8 +306,11 @@ class TestPlugwise:
         pp4 = PrettyPrinter(indent=4)
         pp8 = PrettyPrinter(indent=8)
         _LOGGER.debug("Device list:\n%s", pp4.pformat(device_list))
+        all_device_data = smile.get_all_device_data()
+        assert list(all_device_data) == list(device_list)
         for dev_id, details in device_list.items():
             data = smile.get_device_data(dev_id)
+            assert all_device_data[dev_id] == data
             self._write_json("get_device_data/" + dev_id, data)
             _LOGGER.debug(
                 "%s",
@@ -943,6 +995,95 @@ class TestPlugwise:
         await smile.close_connection()
         await self.disconnect(server, client)
 
+    @pytest.mark.asyncio
+    async def test_connect_adam_zone_per_device_concurrent(self):
+        """Test an Adam with a zone per device setup, updating concurrently."""
+        # testdata dictionary with key ctrl_id_dev_id => keys:values
+        testdata = {
+            # Lisa WK
+            "b59bcebaf94b499ea7d46e4a66fb62d8": {
+                "setpoint": 21.5,
+                "temperature": 21.1,
+                "battery": 0.34,
+            },
+            # Adam
+            "fe799307f1624099878210aa0b9f1475": {
+                "outdoor_temperature": 7.69,
+            },
+            # Modem
+            "675416a629f343c495449970e2ca37b5": {
+                "electricity_consumed": 12.2,
+                "relay": True,
+            },
+        }
+
+        self.smile_setup = "adam_zone_per_device"
+        server, smile, client = await self.connect_wrapper(max_concurrent_requests=3)
+        assert smile.smile_hostname == "smile000000"
+
+        _LOGGER.info("Basics:")
+        _LOGGER.info(" # Assert type = thermostat")
+        assert smile.smile_type == "thermostat"
+        _LOGGER.info(" # Assert version")
+        assert smile.smile_version[0] == "3.0.15"
+
+        assert "af82e4ccf9c548528166d38e560662a4" in smile.notifications
+
+        await self.device_test(smile, testdata)
+        await smile.close_connection()
+        await self.disconnect(server, client)
+
+    @pytest.mark.asyncio
+    async def test_connect_adam_zone_per_device_domain_objects_only(self):
+        """Test an Adam with a zone per device setup, using domain_objects only."""
+        # testdata dictionary with key ctrl_id_dev_id => keys:values
+        testdata = {
+            # Lisa WK
+            "b59bcebaf94b499ea7d46e4a66fb62d8": {
+                "setpoint": 21.5,
+                "temperature": 21.1,
+                "battery": 0.34,
+                "selected_schedule": "GF7  Woonkamer",
+            },
+            # CV pomp
+            "78d1126fc4c743db81b61c20e88342a7": {
+                "electricity_consumed": 35.8,
+                "electricity_consumed_interval": 5.85,
+                "relay": True,
+            },
+            # Adam
+            "fe799307f1624099878210aa0b9f1475": {
+                "outdoor_temperature": 7.69,
+            },
+        }
+
+        self.smile_setup = "adam_zone_per_device"
+        server, smile, client = await self.connect_wrapper(domain_objects_only=True)
+        assert smile.smile_hostname == "smile000000"
+
+        _LOGGER.info("Basics:")
+        _LOGGER.info(" # Assert data derived from domain_objects")
+        assert smile._appliances is smile._domain_objects  # pylint: disable=protected-access
+        assert smile._locations is smile._domain_objects  # pylint: disable=protected-access
+        _LOGGER.info(" # Assert master thermostat")
+        assert not smile.single_master_thermostat()
+
+        await self.device_test(smile, testdata)
+        await self.tinker_thermostat(
+            smile, "c50f167537524366a5af7aa3942feb1e", good_schemas=["GF7  Woonkamer"]
+        )
+        await self.tinker_relay(smile, ["675416a629f343c495449970e2ca37b5"])
+        await smile.close_connection()
+        await self.disconnect(server, client)
+
+        _LOGGER.info(" # Assert legacy falls back to all endpoints")
+        self.smile_setup = "stretch_v31"
+        server, smile, client = await self.connect_wrapper(domain_objects_only=True)
+        assert smile._smile_legacy  # pylint: disable=protected-access
+        assert smile._appliances is not smile._domain_objects  # pylint: disable=protected-access
+        await smile.close_connection()
+        await self.disconnect(server, client)
+
     @pytest.mark.asyncio
     async def test_connect_adam_multiple_devices_per_zone(self):
         """Test a broad setup of Adam with multiple devices per zone setup."""
@@ -1269,6 +1410,788 @@ class TestPlugwise:
         await smile.close_connection()
         await self.disconnect(server, client)
 
+    @pytest.mark.asyncio
+    async def test_retry_policy(self):
+        """Test retrying keeps the request intact and respects the policy."""
+        requests = []
+
+        async def slow_put(request):
+            """Respond too late."""
+            requests.append((request.method, await request.text()))
+            await asyncio.sleep(0.2)
+            raise aiohttp.web.HTTPAccepted(text="<xml />")
+
+        async def busy_get(request):
+            """Respond busy, until asked for the third time."""
+            requests.append((request.method, None))
+            if len(requests) < 3:
+                raise aiohttp.web.HTTPServiceUnavailable(text="busy")
+            return aiohttp.web.Response(text="<locations />")
+
+        app = aiohttp.web.Application()
+        app.router.add_route("PUT", "/core/locations{tail:.*}", slow_put)
+        app.router.add_get("/core/locations", busy_get)
+        server = aiohttp.test_utils.TestServer(
+            app, port=aiohttp.test_utils.unused_port(), scheme="http", host="127.0.0.1"
+        )
+        await server.start_server()
+        client = aiohttp.test_utils.TestClient(server)
+
+        policy = RetryPolicy(retries={"put": 2}, backoff=0.01)
+        smile = Smile(
+            host=server.host,
+            password="abcdefgh",
+            port=server.port,
+            timeout=0.05,
+            websession=client.session,
+            retry_policy=policy,
+        )
+
+        _LOGGER.info("- Retrying a timed out PUT as PUT")
+        try:
+            await smile.request("/core/locations", method="put", data="<setpoint />")
+            assert False
+        except Smile.DeviceTimeoutError:
+            assert requests == [("PUT", "<setpoint />")] * 3
+
+        _LOGGER.info("- Not repeating a write that is not idempotent")
+        requests.clear()
+        try:
+            await smile.request("/core/locations", method="put", idempotent=False)
+            assert False
+        except Smile.DeviceTimeoutError:
+            assert len(requests) == 1
+
+        _LOGGER.info("- Retrying a busy response")
+        requests.clear()
+        xml = await smile.request("/core/locations")
+        assert xml.tag == "locations"
+        assert len(requests) == 3
+
+        assert policy.delay(10) <= policy.max_backoff
+        await self.disconnect(server, client)
+
+    @pytest.mark.asyncio
+    async def test_circuit_breaker(self):
+        """Test failing fast on an unreachable Smile and probing it again."""
+        requests = []
+        unreachable = True
+
+        async def locations(request):
+            """Respond too late while unreachable."""
+            requests.append(request.method)
+            if unreachable:
+                await asyncio.sleep(0.2)
+            return aiohttp.web.Response(text="<locations />")
+
+        app = aiohttp.web.Application()
+        app.router.add_get("/core/locations", locations)
+        server = aiohttp.test_utils.TestServer(
+            app, port=aiohttp.test_utils.unused_port(), scheme="http", host="127.0.0.1"
+        )
+        await server.start_server()
+        client = aiohttp.test_utils.TestClient(server)
+
+        smile = Smile(
+            host=server.host,
+            password="abcdefgh",
+            port=server.port,
+            timeout=0.05,
+            websession=client.session,
+            retry_policy=RetryPolicy(retries={"get": 0}),
+            circuit_breaker=CircuitBreaker(failure_threshold=2, reset_timeout=0.1),
+        )
+        assert smile.circuit_state == "closed"
+
+        _LOGGER.info("- Opening the circuit after repeated timeouts")
+        for dummy in range(2):
+            try:
+                await smile.request("/core/locations")
+                assert False
+            except Smile.DeviceTimeoutError:
+                assert True
+        assert smile.circuit_state == "open"
+
+        _LOGGER.info("- Failing fast while open")
+        try:
+            await smile.request("/core/locations")
+            assert False
+        except Smile.CircuitOpenError:
+            assert len(requests) == 2
+
+        _LOGGER.info("- Reopening after a failed probe")
+        await asyncio.sleep(0.1)
+        assert smile.circuit_state == "half_open"
+        try:
+            await smile.request("/core/locations")
+            assert False
+        except Smile.CircuitOpenError:
+            assert len(requests) == 3
+        assert smile.circuit_state == "open"
+
+        _LOGGER.info("- Probing again after a cancelled probe")
+        await asyncio.sleep(0.1)
+        assert smile.circuit_state == "half_open"
+        probe = asyncio.ensure_future(smile.request("/core/locations"))
+        await asyncio.sleep(0.02)
+        probe.cancel()
+        try:
+            await probe
+            assert False
+        except asyncio.CancelledError:
+            assert len(requests) == 4
+        assert smile.circuit_state == "open"
+        await asyncio.sleep(0.1)
+        assert smile.circuit_state == "half_open"
+
+        _LOGGER.info("- Closing after a successful probe")
+        unreachable = False
+        await asyncio.sleep(0.1)
+        xml = await smile.request("/core/locations")
+        assert xml.tag == "locations"
+        assert len(requests) == 6
+        assert smile.circuit_state == "closed"
+
+        await self.disconnect(server, client)
+
+    @pytest.mark.asyncio
+    async def test_shared_transport(self):
+        """Test multiple Smiles sharing one connection pool."""
+        self.smile_setup = "p1v3"
+        app = await self.setup_app()
+        server = aiohttp.test_utils.TestServer(
+            app, port=aiohttp.test_utils.unused_port(), scheme="http", host="127.0.0.1"
+        )
+        await server.start_server()
+
+        transport = SharedTransport()
+        smiles = [
+            Smile(
+                host=server.host,
+                password="abcdefgh",
+                port=server.port,
+                transport=transport,
+            )
+            for dummy in range(3)
+        ]
+        for smile in smiles:
+            assert smile.websession is None
+            assert await smile.connect()
+
+        assert transport.users == 3
+        session = smiles[0].websession
+        assert all(smile.websession is session for smile in smiles)
+
+        _LOGGER.info("- Closing the session with the last Smile")
+        await smiles[0].close_connection()
+        await smiles[0].close_connection()
+        await smiles[1].close_connection()
+        assert transport.users == 1
+        assert not session.closed
+        await smiles[2].close_connection()
+        assert transport.users == 0
+        assert session.closed
+
+        await server.close()
+
+    @pytest.mark.asyncio
+    async def test_fleet(self):
+        """Test polling multiple gateways as a fleet."""
+        self.smile_setup = "adam_plus_anna"
+        app = await self.setup_app()
+        server = aiohttp.test_utils.TestServer(
+            app, port=aiohttp.test_utils.unused_port(), scheme="http", host="127.0.0.1"
+        )
+        await server.start_server()
+
+        fleet = SmileFleet(max_concurrent=4, interval=300)
+        for count in range(10):
+            fleet.add_gateway(
+                f"adam_{count}", server.host, "abcdefgh", port=server.port
+            )
+        fleet.add_gateway(
+            "unreachable",
+            server.host,
+            "abcdefgh",
+            port=aiohttp.test_utils.unused_port(),
+            retry_policy=RetryPolicy(retries={"get": 0}),
+        )
+        malformed = fleet.add_gateway(
+            "malformed", server.host, "abcdefgh", port=server.port
+        )
+
+        async def connect_malformed():
+            """Fail like a Smile reporting a malformed firmware version."""
+            raise ValueError("4.x is not valid SemVer string")
+
+        malformed.connect = connect_malformed
+
+        _LOGGER.info("- Polling all gateways")
+        cycle = await fleet.poll()
+        assert len(cycle) == 12
+        assert cycle["unreachable"]["error"] == "ClientConnectorError"
+        assert cycle["malformed"]["error"] == "ValueError"
+        for count in range(10):
+            result = cycle[f"adam_{count}"]
+            assert result["error"] is None
+            assert result["duration"] > 0
+            plug = result["device_data"]["aa6b0002df0a46e1b1eb94beb61eddfe"]
+            assert plug["electricity_consumed"] == 10.3
+
+        _LOGGER.info("- Nothing due within the interval")
+        assert fleet.due() == []
+        assert await fleet.poll() == {}
+        assert len(fleet.snapshot) == 12
+
+        await fleet.close()
+        assert fleet.transport.users == 0
+        await server.close()
+
+    @pytest.mark.asyncio
+    async def test_topology_cache(self):
+        """Test the topology is built once per update."""
+        self.smile_setup = "adam_zone_per_device"
+        server, smile, client = await self.connect_wrapper()
+
+        topology = smile._get_topology()  # pylint: disable=protected-access
+        for dev_id in smile.get_all_devices():
+            smile.get_device_data(dev_id)
+        assert smile._get_topology() is topology  # pylint: disable=protected-access
+
+        _LOGGER.info("- Master and slave thermostats elected once")
+        thermostats = smile.thermostats
+        assert smile.thermostats is thermostats
+        location = thermostats["08963fec7c53423ca5680aa4cb502c63"]
+        assert location["master"] == "f1fee6043d3642a9b0a65297455f008e"
+        assert location["slaves"] == {"680423ff840043738f42cc7f1ff97a36"}
+        assert not smile.single_master_thermostat()
+        try:
+            location["master"] = None
+            assert False
+        except TypeError:
+            assert True
+
+        _LOGGER.info("- Callers can't alter the topology")
+        devices = smile.get_all_devices()
+        for details in devices.values():
+            details["name"] = "altered"
+        assert "altered" not in [
+            details["name"] for details in smile.get_all_devices().values()
+        ]
+
+        _LOGGER.info("- Rebuilt after an update")
+        await smile.full_update_device()
+        assert smile._get_topology() is not topology  # pylint: disable=protected-access
+        assert smile.get_all_devices() == topology["devices"]
+
+        await smile.close_connection()
+        await self.disconnect(server, client)
+
+    @pytest.mark.asyncio
+    async def test_measurement_index(self):
+        """Test the measurement index is built once per retrieved tree."""
+        self.smile_setup = "p1v3"
+        server, smile, client = await self.connect_wrapper()
+
+        # pylint: disable=protected-access
+        measurements = smile._get_measurements(smile._domain_objects)
+        assert smile._get_measurements(smile._domain_objects) is measurements
+
+        home = "a455b61e52394b2db5081ce025a430f3"
+        key = (home, "point_log", "electricity_consumed")
+        assert measurements["location"][(*key, "nl_peak")] == (
+            "650.00",
+            dt.datetime(
+                2020, 3, 12, 21, 14, 1, tzinfo=dt.timezone(dt.timedelta(hours=1))
+            ),
+        )
+        assert measurements["location"][(*key, "nl_offpeak")][0] == "0.00"
+        # Without tariff the first measurement of the log is used
+        assert measurements["location"][(*key, None)][0] == "650.00"
+
+        location = smile._get_element(smile._domain_objects, "location", home)
+        assert location.find("name").text == "Home"
+        assert smile._get_element(smile._domain_objects, "location", "none") is None
+        assert smile._get_element(smile._domain_objects, "rule", home) is None
+
+        _LOGGER.info("- Rebuilt after an update")
+        await smile.full_update_device()
+        assert smile._get_measurements(smile._domain_objects) is not measurements
+        assert len(smile._tree_indexes) == 1
+
+        await smile.close_connection()
+        await self.disconnect(server, client)
+
+    @pytest.mark.asyncio
+    async def test_rule_index(self):
+        """Test the rules are indexed by template tag and name per location."""
+        self.smile_setup = "adam_plus_anna"
+        server, smile, client = await self.connect_wrapper()
+
+        loc_id = "009490cc2f674ce6b576863fbb64f867"
+        schedule_id = "12f68057511a4445a162fb307d437cf1"
+        tag = "zone_preset_based_on_time_and_presence_with_override"
+        assert smile.get_rule_ids_by_tag(tag, loc_id) == {schedule_id: loc_id}
+        assert smile.get_rule_ids_by_name("Weekschema", loc_id) == {
+            schedule_id: loc_id
+        }
+        assert smile.get_rule_ids_by_name("Weekschema", "unknown") is None
+
+        # pylint: disable=protected-access
+        rule = smile._get_rules(smile._domain_objects)["rules"][schedule_id]
+        assert rule["name"] == "Weekschema"
+        assert rule["active"]
+        assert rule["template"] == "d0720497b6794471a7ad2f903d4b7cfc"
+        assert rule["modified_date"].year == 2020
+
+        await smile.close_connection()
+        await self.disconnect(server, client)
+
+    @pytest.mark.asyncio
+    async def test_group_index(self):
+        """Test the group memberships and the switch group relay state."""
+        self.smile_setup = "adam_zone_per_device"
+        server, smile, client = await self.connect_wrapper()
+
+        group_id = "e117db6848394c8cb70d9c28e63d92d2"
+        members = ["b59bcebaf94b499ea7d46e4a66fb62d8", "78d1126fc4c743db81b61c20e88342a7"]
+        # pylint: disable=protected-access
+        groups = smile._get_groups(smile._domain_objects)
+        assert groups["members"][group_id] == members
+        assert groups["groups"][members[0]] == group_id
+
+        _LOGGER.info("- Only the first group of an appliance counts")
+        domain_objects = etree.fromstring(etree.tostring(smile._domain_objects))
+        appl_groups = domain_objects.find(f"appliance[@id='{members[0]}']/groups")
+        etree.SubElement(appl_groups, "group", id="second")
+        assert "second" not in smile._index_groups(domain_objects)["members"]
+
+        # Pumping groups are no switch groups
+        assert group_id not in smile.get_group_switches()
+
+        await smile.close_connection()
+        await self.disconnect(server, client)
+
+        self.smile_setup = "stretch_v31"
+        server, smile, client = await self.connect_wrapper()
+
+        # Switch group without members
+        group_id = "d950b314e9d8499f968e6db8d82ef78c"
+        assert smile.get_group_switches()[group_id]["members"] == []
+        assert not smile.get_device_data(group_id)["relay"]
+
+        # Koelkast
+        assert smile._get_relay_state("e1c884e7dede431dadee09506ec4f859")
+        assert not smile._get_relay_state("unknown")
+
+        await smile.close_connection()
+        await self.disconnect(server, client)
+
+    @pytest.mark.asyncio
+    async def test_preset_cache(self):
+        """Test the presets are kept until their rules are modified."""
+        for setup, loc_id in [
+            ("adam_plus_anna", "009490cc2f674ce6b576863fbb64f867"),
+            ("legacy_anna", None),
+        ]:
+            self.smile_setup = setup
+            server, smile, client = await self.connect_wrapper()
+
+            # pylint: disable=protected-access
+            presets = smile._get_presets(loc_id)
+            assert smile._get_presets(loc_id) is presets
+            try:
+                presets["home"] = (0, 0)
+                assert False
+            except TypeError:
+                assert True
+
+            # Callers get their own copy
+            copy = smile.get_presets(loc_id)
+            copy["home"][0] = 0
+            assert smile.get_presets(loc_id)["home"][0] == presets["home"][0]
+
+            _LOGGER.info("- Still kept after an update")
+            await smile.full_update_device()
+            assert smile._get_presets(loc_id) is presets
+
+            await smile.close_connection()
+            await self.disconnect(server, client)
+
+    @pytest.mark.asyncio
+    async def test_schedule_timeline(self):
+        """Test the compiled schedules and the next schedule change."""
+        self.smile_setup = "adam_plus_anna"
+        server, smile, client = await self.connect_wrapper()
+
+        loc_id = "009490cc2f674ce6b576863fbb64f867"
+        schedule_id = "12f68057511a4445a162fb307d437cf1"
+        monday = dt.datetime(2020, 3, 16, 6, 0)
+        assert smile.get_schedule_next_change(loc_id, monday) == (
+            dt.datetime(2020, 3, 16, 7, 30),
+            20.0,
+        )
+        assert smile.get_schedule_next_change(loc_id, monday.replace(hour=8)) == (
+            dt.datetime(2020, 3, 16, 16, 30),
+            20.5,
+        )
+        assert smile.get_schedule_next_change("unknown", monday) is None
+
+        # pylint: disable=protected-access
+        timeline = smile._get_schedule_timeline(schedule_id, loc_id)
+        assert smile._get_schedule_timeline(schedule_id, loc_id) is timeline
+
+        _LOGGER.info("- Replaced and emptied schedules")
+        domain_objects = etree.fromstring(etree.tostring(smile._domain_objects))
+        rule = domain_objects.find(f"rule[@id='{schedule_id}']")
+        rule.set("id", "replaced")
+        smile._set_documents(smile._appliances, domain_objects, smile._locations)
+        assert smile.get_schedule_next_change(loc_id, monday) == (
+            dt.datetime(2020, 3, 16, 7, 30),
+            20.0,
+        )
+        # The timeline of the removed schedule is dropped
+        assert list(smile._schedule_timelines) == ["replaced"]
+
+        domain_objects = etree.fromstring(etree.tostring(domain_objects))
+        rule = domain_objects.find("rule[@id='replaced']")
+        rule.remove(rule.find("directives"))
+        smile._set_documents(smile._appliances, domain_objects, smile._locations)
+        assert smile.get_schedule_next_change(loc_id, monday) is None
+
+        _LOGGER.info("- Periods passing midnight")
+        timeline = Smile._compile_schedule(
+            {"[su 22:00,mo 07:00)": 16.0, "[mo 06:00,mo 08:00)": 19.0}
+        )
+        # A period applies on its start and end day, between its start and end time
+        assert timeline == (
+            [0, 360, 480, 1320, 1440, 8640, 9060, 9960],
+            [16.0, 19.0, None, 16.0, None, 16.0, None, 16.0],
+        )
+        assert Smile._get_timeline_setpoint(timeline, 9959) is None
+        assert Smile._get_timeline_setpoint(timeline, 10079) == 16.0
+
+        await smile.close_connection()
+        await self.disconnect(server, client)
+
+    def test_parse_timestamp(self):
+        """Test parsing the Plugwise timestamps."""
+        utc = dt.timezone.utc
+        cet = dt.timezone(dt.timedelta(hours=1))
+        for timestamp, moment in [
+            (
+                "2020-03-20T18:19:40.926+01:00",
+                dt.datetime(2020, 3, 20, 18, 19, 40, 926000, tzinfo=cet),
+            ),
+            (
+                "2020-03-20T18:19:40+01:00",
+                dt.datetime(2020, 3, 20, 18, 19, 40, tzinfo=cet),
+            ),
+            (
+                "2020-03-20T17:19:40.9Z",
+                dt.datetime(2020, 3, 20, 17, 19, 40, 900000, tzinfo=utc),
+            ),
+            ("2020-03-20T18:19:40", dt.datetime(2020, 3, 20, 18, 19, 40)),
+        ]:
+            assert parse_timestamp(timestamp) == moment
+            assert parse_timestamp(timestamp).utcoffset() == moment.utcoffset()
+
+        try:
+            parse_timestamp("yesterday")
+            assert False
+        except ValueError:
+            assert True
+
+    @pytest.mark.asyncio
+    async def test_smile_state(self):
+        """Test deriving the data from XML documents, without a connection."""
+        self.smile_setup = "adam_zone_per_device"
+        server, smile, client = await self.connect()
+        expected = (smile.get_all_devices(), smile.get_all_device_data())
+
+        state, documents = self.load_state(self.smile_setup)
+        assert (state.get_all_devices(), state.get_all_device_data()) == expected
+        loc_id = "c50f167537524366a5af7aa3942feb1e"
+        assert state.get_presets(loc_id) == smile.get_presets(loc_id)
+        assert state.get_schemas(loc_id) == smile.get_schemas(loc_id)
+
+        # Appliances and locations are derived from domain_objects when missing
+        state = SmileState.from_documents(
+            None, documents["domain_objects"], None, "thermostat", smile_name="Adam"
+        )
+        assert state.get_all_devices().keys() == expected[0].keys()
+        expected = (state.get_all_devices(), state.get_all_device_data())
+
+        _LOGGER.info(" # Assert the state survives pickling, i.e. to a process")
+        copy = pickle.loads(pickle.dumps(state))
+        # pylint: disable=protected-access
+        assert copy._appliances is copy._domain_objects
+        assert (copy.get_all_devices(), copy.get_all_device_data()) == expected
+        copy = pickle.loads(pickle.dumps(smile.get_state()))
+        assert type(copy) is SmileState
+        assert copy.get_all_device_data() == smile.get_all_device_data()
+        assert copy.notifications == smile.notifications
+
+        try:
+            SmileState.from_documents(None, b"Internal Server Error", None, "power")
+            assert False
+        except SmileState.InvalidXMLError:
+            assert True
+
+        await smile.close_connection()
+        await self.disconnect(server, client)
+
+    def test_get_changes(self):
+        """Test reporting only the device-data changed since the previous call."""
+        state, documents = self.load_state("adam_zone_per_device")
+
+        changed, added, removed = state.get_changes()
+        assert changed == {}
+        assert added == state.get_all_device_data()
+        assert removed == []
+        assert state.get_changes() == ({}, {}, [])
+
+        _LOGGER.info(" # Assert altering the reported data does not alter the diff")
+        for data in added.values():
+            data.clear()
+        assert state.get_changes() == ({}, {}, [])
+
+        _LOGGER.info(" # Assert a new measurement and a removed Plug are reported")
+        # pylint: disable=protected-access
+        appliances = etree.fromstring(documents["appliances"])
+        lisa = "b59bcebaf94b499ea7d46e4a66fb62d8"
+        appliances.find(
+            f"appliance[@id='{lisa}']/logs/point_log[type='temperature']"
+            "/period/measurement"
+        ).text = "22.0"
+        plug = appliances.find("appliance[@id='78d1126fc4c743db81b61c20e88342a7']")
+        appliances.remove(plug)
+        state._set_documents(appliances, state._domain_objects, state._locations)
+
+        changed, added, removed = state.get_changes()
+        assert changed == {lisa: {"temperature": 22.0}}
+        assert added == {}
+        assert removed == ["78d1126fc4c743db81b61c20e88342a7"]
+
+    def test_incremental_extraction(self):
+        """Test reading only the logs with a new updated_date again."""
+        state, documents = self.load_state("adam_zone_per_device")
+        expected = state.get_all_device_data()
+
+        # pylint: disable=protected-access
+        state._incremental_extraction = True
+        state._set_documents(
+            etree.fromstring(documents["appliances"]),
+            state._domain_objects,
+            state._locations,
+        )
+        assert state.get_changes() == ({}, expected, [])
+
+        lisa = "b59bcebaf94b499ea7d46e4a66fb62d8"
+        log = f"appliance[@id='{lisa}']/logs/point_log[type='temperature']"
+        for updated_date, temperature in [
+            # Without a new updated_date the previous value is kept
+            (None, 21.1),
+            ("2020-03-20T18:20:40.926+01:00", 22.0),
+        ]:
+            appliances = etree.fromstring(documents["appliances"])
+            appliances.find(f"{log}/period/measurement").text = "22.0"
+            if updated_date is not None:
+                appliances.find(f"{log}/updated_date").text = updated_date
+            state._set_documents(appliances, state._domain_objects, state._locations)
+            assert state.get_device_data(lisa)["temperature"] == temperature
+        assert state.get_changes() == ({lisa: {"temperature": 22.0}}, {}, [])
+        assert len(state._measured_logs["appliances"]) > 0
+
+        assert Smile._format_measure("21.13") == 21.1
+
+    @pytest.mark.asyncio
+    async def test_batch_analyse(self, tmp_path):
+        """Test analysing the XML dumps of the test setups in worker processes."""
+        output = str(tmp_path / "results.jsonl")
+        stats = batch.analyse("tests", output, processes=2)
+        assert stats["analysed"] == 19
+        assert stats["errors"] == 1
+        assert stats["rate"] > 0
+
+        with open(output) as lines:
+            results = [json_lines.loads(line) for line in lines]
+        results = {result["dump"]: result for result in results}
+        assert results["faulty_stretch"]["error"].startswith("ConnectionFailedError")
+        assert results["smile_p1_v2"]["smile"] == {
+            "name": "P1",
+            "type": "power",
+            "version": "2.5.9",
+            "legacy": True,
+        }
+
+        _LOGGER.info(" # Assert the results match a connected Smile")
+        self.smile_setup = "stretch_v31"
+        server, smile, client = await self.connect()
+        result = results["stretch_v31"]
+        assert result["device_data"] == json_lines.loads(
+            json_lines.dumps(smile.get_all_device_data())
+        )
+        assert result["devices"].keys() == smile.get_all_devices().keys()
+        await smile.close_connection()
+        await self.disconnect(server, client)
+
+        _LOGGER.info(" # Assert an interrupted analysis is resumed")
+        with open(output, "rb+") as lines:
+            lines.truncate(os.path.getsize(output) - 10)
+        stats = batch.analyse("tests", output, processes=1)
+        assert stats["analysed"] == 1
+        assert stats["skipped"] == 18
+        with open(output) as lines:
+            dumps = [json_lines.loads(line)["dump"] for line in lines]
+        assert sorted(dumps) == sorted(results)
+
+        _LOGGER.info(" # Assert a malformed dump does not stop the analysis")
+        root = tmp_path / "dumps"
+        for dump in ["anna_v4", "malformed", "p1v3"]:
+            (root / dump).mkdir(parents=True)
+            for filename in batch.DUMP_FILES.values():
+                source = f"tests/{dump.replace('malformed', 'anna_v4')}/{filename}"
+                if os.path.exists(source):
+                    with open(source, "rb") as xml:
+                        data = xml.read()
+                    if dump == "malformed":
+                        data = data.replace(b">4.0.15<", b">4.x<")
+                    (root / dump / filename).write_bytes(data)
+        output = str(tmp_path / "malformed.jsonl")
+        for dummy in range(2):
+            stats = batch.analyse(str(root), output, processes=1)
+        assert stats["skipped"] == 3
+        with open(output) as lines:
+            results = [json_lines.loads(line) for line in lines]
+        dumps = [result["dump"] for result in results]
+        assert dumps == ["anna_v4", "malformed", "p1v3"]
+        assert results[1]["error"].startswith("ValueError: ")
+        assert results[0]["error"] is None and results[2]["error"] is None
+
+    def test_light_import(self):
+        """Test importing the module leaves the date and version libraries out."""
+        code = (
+            "import sys; import Plugwise_Smile.Smile; "
+            "print(' '.join(m for m in ('dateutil', 'pytz', 'semver') "
+            "if m in sys.modules))"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", code],
+            capture_output=True,
+            check=True,
+            cwd=os.path.dirname(os.path.dirname(__file__)),
+        )
+        assert result.stdout.strip() == b""
+
+        code = (
+            "import sys; import Plugwise_Smile.state; "
+            "print('aiohttp' in sys.modules)"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", code],
+            capture_output=True,
+            check=True,
+            cwd=os.path.dirname(os.path.dirname(__file__)),
+        )
+        assert result.stdout.strip() == b"False"
+
+    @pytest.mark.asyncio
+    async def test_parse_chunked_response(self):
+        """Test parsing a response body split at awkward chunk boundaries."""
+
+        class ChunkedContent:
+            """Mimic the aiohttp response stream."""
+
+            def __init__(self, chunks):
+                self.chunks = chunks
+
+            async def iter_any(self):
+                for chunk in self.chunks:
+                    yield chunk
+
+        class ChunkedResponse:
+            """Mimic the aiohttp response."""
+
+            charset = "utf-8"
+
+            def __init__(self, chunks):
+                self.content = ChunkedContent(chunks)
+
+        websession = aiohttp.ClientSession()
+        smile = Smile(host="127.0.0.1", password="abcdefgh", websession=websession)
+
+        # Illegal & at the end of a chunk and a multi-byte character split up
+        body = "<domain_objects><name>Tom & Jerry é</name></domain_objects>"
+        data = body.encode()
+        split = data.index(b"&") + 1
+        chunks = [data[:split], data[split : split + 13], data[split + 13 :]]
+        xml = await smile._parse_response(  # pylint: disable=protected-access
+            ChunkedResponse(chunks), "/core/domain_objects"
+        )
+        assert xml.find("name").text == "Tom & Jerry é"
+        assert smile.xml_repairs == 1
+
+        # Clean data is returned untouched
+        assert Smile.escape_illegal_xml_characters(b"Tom & Jerry") == b"Tom &amp; Jerry"
+        clean = b"<name>Tom &amp; Jerry &#233;</name>"
+        assert Smile.escape_illegal_xml_characters(clean) is clean
+
+        for chunks, error in [
+            ([], Smile.ResponseError),
+            ([b"<err", b"or>bad</error>"], Smile.ResponseError),
+            ([b"Internal ", b"Server Error"], Smile.InvalidXMLError),
+        ]:
+            try:
+                await smile._parse_response(  # pylint: disable=protected-access
+                    ChunkedResponse(chunks), "/core/domain_objects"
+                )
+                assert False
+            except error:
+                assert True
+
+        await websession.close()
+
+    @pytest.mark.asyncio
+    async def test_executor_mode(self):
+        """Test parsing and extracting the data in an executor."""
+        self.smile_setup = "adam_zone_per_device"
+        server, smile, client = await self.connect()
+        expected = await smile.get_snapshot()
+        assert expected == (smile.get_all_devices(), smile.get_all_device_data())
+        await smile.close_connection()
+        await self.disconnect(server, client)
+
+        server, smile, client = await self.connect(executor_mode=True)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            smile._executor = executor  # pylint: disable=protected-access
+            await smile.full_update_device()
+            devices, device_data = await smile.get_snapshot()
+        assert (devices, device_data) == expected
+
+        # The results are not shared with the Smile
+        dev_id = "b59bcebaf94b499ea7d46e4a66fb62d8"
+        device_data[dev_id]["setpoint"] = 0
+        devices[dev_id]["name"] = "Changed"
+        assert smile.get_device_data(dev_id)["setpoint"] == 21.5
+        assert smile.get_all_devices()[dev_id]["name"] == "Zone Lisa WK"
+
+        for data, error in [
+            (b"", Smile.ResponseError),
+            (b"<error>bad</error>", Smile.ResponseError),
+            (b"Internal Server Error", Smile.InvalidXMLError),
+        ]:
+            try:
+                smile._parse_xml(  # pylint: disable=protected-access
+                    data, "utf-8", "/core/domain_objects"
+                )
+                assert False
+            except error:
+                assert True
+
+        await smile.close_connection()
+        await self.disconnect(server, client)
+
     @pytest.mark.asyncio
     async def test_fail_legacy_system(self):
         """Test erronous legacy stretch system."""